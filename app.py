@@ -1,4 +1,4 @@
-from flask import session, Flask, redirect, url_for, request, render_template
+from flask import session, Flask, redirect, url_for, request, render_template, jsonify, Response, stream_with_context, get_template_attribute
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
@@ -10,14 +10,24 @@ import logging
 import numpy as np
 import openai
 import pickle
+import json
 import time
+import hmac
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from asgiref.wsgi import WsgiToAsgi
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
 
-from twitter import fetch_tweets
-from clustering import cluster_threads, meta_cluster, TweetCluster
-from summary import summarize_clusters
-from meta_summary import meta_summarize
+from sqlalchemy.exc import IntegrityError
+from jobs import JobRunner
+from pipeline import iter_pipeline, FetchError
+from result_store import get_store
+from prewarm import Prewarmer
+import metrics
+from hedging import get_hedger
 
 DEBUG = False
 
@@ -25,7 +35,31 @@ load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'  # Use SQLite for simplicity
+
+def database_url():
+    # SQLite for local development; point DATABASE_URL at Postgres in production
+    url = environ.get('DATABASE_URL', 'sqlite:////tmp/test.db')
+    # Heroku-style URLs use a scheme SQLAlchemy no longer accepts
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    options = {
+        'pool_size': int(environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 30,
+        # Drop connections the server closed while they sat in the pool
+        'pool_pre_ping': True,
+        'pool_recycle': 30 * 60,
+    }
+    if url.startswith('sqlite'):
+        # Wait for other workers' writes instead of failing with "database is locked"
+        options['connect_args'] = {'timeout': 30}
+    return options
+
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
@@ -47,11 +81,31 @@ class User(UserMixin, db.Model):
     def set_access_token_secret(self, secret):
         self.access_token_secret = secret
 
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    # Set to the user id while the job is queued or running. The unique
+    # constraint stops two workers from starting a pipeline for the same user.
+    active_key = db.Column(db.Integer, unique=True)
+    status = db.Column(db.String(16))
+    stage = db.Column(db.String(32))
+    percent = db.Column(db.Integer)
+    error = db.Column(db.String(32))
+    created_at = db.Column(db.Float)
+    updated_at = db.Column(db.Float)
+
+    def to_json(self):
+        return {'status': self.status, 'stage': self.stage, 'percent': self.percent, 'error': self.error}
+
+class Visit(db.Model):
+    """A /tweets page view, for predicting when the user will be back."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    visited_at = db.Column(db.Float, index=True)
+
 @login_manager.user_loader
 def user_loader(user_id):
-    print(f'user loader id {user_id}')
-    print(f'user {db.session.query(User).get(user_id)}')
-    return db.session.query(User).get(user_id)
+    return db.session.get(User, user_id)
 
 @app.route('/')
 def home():
@@ -99,72 +153,300 @@ def authorize():
     return redirect(url_for('tweets'))
 
 OPENAI_ERROR_MSG = 'Oops, we probably hit the OpenAI API limit. I\'m not made of money!'
+JOB_ERROR_MSGS = {
+    'twitter': 'Oops, we probably hit the Twitter API limit, which is surprisingly expensive!',
+    'openai': OPENAI_ERROR_MSG,
+    'stale': 'Oops, something went wrong. Try refreshing the page?',
+}
+
+# Refreshes are incremental, so they can run far more often than the cache expires
+REFRESH_INTERVAL = int(environ.get('REFRESH_INTERVAL', 30 * 60))
+# A job whose progress hasn't moved in this long belongs to a dead worker
+JOB_STALE_SECONDS = 10 * 60
+# What ?engine= may ask for
+ENGINES = ('llm', 'embedding')
+
+job_runner = JobRunner(max_jobs=int(environ.get('MAX_CONCURRENT_JOBS', 4)))
+# Async views run on the server's event loop, and refresh jobs on the job
+# runner's, so their blocking calls (SQLAlchemy, the result store, template
+# rendering) go to this pool instead
+blocking_pool = ThreadPoolExecutor(max_workers=int(environ.get('BLOCKING_THREADS', 16)), thread_name_prefix='blocking')
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs func(*args, **kwargs) on the blocking pool, inside the current app and request context."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        blocking_pool, functools.partial(context.run, func, *args, **kwargs))
+# job id -> rendered clusters summarized so far, for /tweets/stream. Only
+# lives in the worker running the job.
+job_fragments = {}
+STREAM_POLL_SECONDS = 0.5
+# Each open stream holds a WSGI thread, and only finds out the client left
+# when it next writes, so idle streams send a comment this often
+STREAM_KEEPALIVE_SECONDS = 15
+
+def update_job(job_id, **fields):
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        for key, value in fields.items():
+            setattr(job, key, value)
+        job.updated_at = time.time()
+        if job.status in ('done', 'failed'):
+            job.active_key = None
+        db.session.commit()
+
+def render_fragment(cluster):
+    with app.app_context():
+        return str(get_template_attribute('_cluster.html', 'render_cluster')(cluster))
+
+async def refresh_job(job_id, user_id, access_token, access_token_secret, engine, reason='visit'):
+    # Set up the OpenAI API client
+    openai.api_key = environ.get('OPENAI_API_KEY')
+    trace = metrics.start_trace(user_id=user_id, job_id=job_id, engine=engine, reason=reason)
+    try:
+        # Other users' jobs share this loop, so nothing blocking runs on it
+        await run_blocking(update_job, job_id, status='running')
+        job_fragments[job_id] = []
+        state = await run_blocking(get_store().load_state, user_id)
+        events = iter_pipeline(access_token, access_token_secret, engine=engine,
+                               batched=environ.get('HASHTAG_BATCHING', '1') == '1', state=state, trace=trace)
+        async for event, payload in events:
+            if event == 'progress':
+                stage, percent = payload
+                await run_blocking(update_job, job_id, stage=stage, percent=percent)
+            elif event == 'summary':
+                job_fragments[job_id].append(await run_blocking(render_fragment, payload))
+            elif event == 'done':
+                clusters, state = payload
+                await run_blocking(get_store().save, user_id, clusters, state)
+    except FetchError as e:
+        print(e)
+        await run_blocking(update_job, job_id, status='failed', error='twitter')
+    except Exception as e:
+        print(e)
+        await run_blocking(update_job, job_id, status='failed', error='openai')
+    else:
+        await run_blocking(update_job, job_id, status='done', stage='done', percent=100)
+    finally:
+        # The finished page is rendered from the cache instead
+        job_fragments.pop(job_id, None)
+        # The pipeline finishes the trace, unless we failed before it started
+        if trace.status == 'running':
+            trace.finish('failed')
+        if reason == 'prewarm':
+            prewarmer.record_cost(trace.cost)
+
+def active_job(user_id):
+    job = db.session.query(Job).filter_by(active_key=user_id).first()
+    if job and time.time() - job.updated_at > JOB_STALE_SECONDS and not job_runner.is_running(user_id):
+        job.status = 'failed'
+        job.error = 'stale'
+        job.active_key = None
+        db.session.commit()
+        return None
+    return job
+
+def start_refresh(user, engine, reason='visit'):
+    """Returns the user's in-flight refresh job, starting one if there isn't any."""
+    job = active_job(user.id)
+    if job:
+        return job
+    now = time.time()
+    job = Job(user_id=user.id, active_key=user.id, status='queued', stage='queued', percent=0,
+              created_at=now, updated_at=now)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker got there first
+        db.session.rollback()
+        return active_job(user.id) or start_refresh(user, engine, reason)
+
+    # The job outlives this request, so don't hand it ORM objects
+    job_id, user_id = job.id, user.id
+    access_token, access_token_secret = user.access_token, user.access_token_secret
+    job_runner.submit(user_id, lambda: refresh_job(job_id, user_id, access_token, access_token_secret, engine, reason))
+    return job
+
+def record_visit(user_id):
+    db.session.add(Visit(user_id=user_id, visited_at=time.time()))
+    db.session.commit()
+
+def prewarm_candidates(since):
+    with app.app_context():
+        # Older visits are no use to the predictions
+        db.session.query(Visit).filter(Visit.visited_at < since).delete()
+        db.session.commit()
+        visits = {}
+        for user_id, visited_at in db.session.query(Visit.user_id, Visit.visited_at).order_by(Visit.user_id):
+            visits.setdefault(user_id, []).append(visited_at)
+    store = get_store()
+    for user_id, times in visits.items():
+        yield user_id, times, store.saved_at(user_id)
+
+def prewarm_refresh(user_id):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        if user is None or not user.access_token:
+            return False
+        start_refresh(user, environ.get('CLUSTERING_ENGINE', 'llm'), reason='prewarm')
+        return True
+
+# Runs in every worker. Job.active_key keeps two workers from refreshing the
+# same user, but each worker spends its own budget.
+prewarmer = Prewarmer(prewarm_candidates, prewarm_refresh, job_runner.is_running)
 
-def load_cache(cache_file, last_cache_time):
-  with open(cache_file, 'rb') as file_:
-    clusters = pickle.load(file_)
-    if clusters and clusters[0].summary.startswith('You might have refreshed the page') and (time.time() - last_cache_time) > 180:
-      raise Exception()
-    return clusters
-  
+@app.before_request
+def start_prewarming():
+    # Started on the first request so the thread is created after uvicorn forks its workers
+    if environ.get('PREWARM', '1') == '1':
+        prewarmer.start()
 
 @app.route('/tweets')
 @login_required
 async def tweets():
-    # Get Twitter API credentials
-    access_token = current_user.access_token
-    access_token_secret = current_user.access_token_secret
-    user_id = current_user.get_id()
-    cache_file = f'/tmp/{user_id}.pkl'
-
-    if os.path.exists(cache_file) and (time.time() - os.path.getmtime(cache_file)) / 60 / 60 < 24:
-      try:
-        last_cache_time = os.path.getmtime(cache_file)
-        clusters = load_cache(cache_file, last_cache_time)
-      except:
-        os.remove(cache_file)
-        return render_template('error.html', message="Oops, something went wrong. Try refreshing the page?")
-    else:
-      last_cache_time = time.time()
-      with open(cache_file, 'wb') as file_:
-        pickle.dump([TweetCluster(threads=[], summary="You might have refreshed the page while it was still loading. Please check back in a minute or two.")], file_)
-      # Fetch tweets
-      try:
-        threads = fetch_tweets(access_token, access_token_secret)
-      except Exception as e:
-        print(e)
-        os.remove(cache_file)
-        return render_template('twitter_error.html')
-      # with open('tweets.pkl', 'wb') as file_:
-      #   pickle.dump(threads, file_)
-      # with open('tweets.pkl', 'rb') as file_:
-      #   threads = pickle.load(file_)
-
-      # Set up the OpenAI API client
-      openai.api_key = environ.get('OPENAI_API_KEY')
-
-      try:
-        print('starting')
-        # Cluster tweets and summarize
-        clusters = await cluster_threads(threads)
-        print('clustered')
-        clusters = await summarize_clusters(clusters)
-        print('summarized')
-
-        # Cluster the clusters if necessary and summarize
-        clusters = meta_cluster(clusters)
-        print('meta clustered')
-        clusters = await meta_summarize(clusters)
-        print('meta summarized')
-      except Exception as e:
-        os.remove(cache_file)
-        return render_template('error.html', message=OPENAI_ERROR_MSG)
-
-      # TODO - replace this with redis
-      with open(cache_file, 'wb') as file_:
-        pickle.dump(clusters, file_)
-
-    next_refresh = last_cache_time + 24 * 60 * 60
-    return render_template('tweets.html', clusters=clusters, next_refresh=next_refresh)
-
-asgi_app = WsgiToAsgi(app)
+    # login_required already loaded the user, outside the event loop
+    user = current_user._get_current_object()
+    engine = request.args.get('engine')
+    if engine not in ENGINES:
+        engine = environ.get('CLUSTERING_ENGINE', 'llm')
+
+    await run_blocking(record_visit, user.id)
+    try:
+      result = await run_blocking(get_store().load, user.get_id())
+    except Exception as e:
+      print(e)
+      return await run_blocking(render_template, 'error.html',
+                                message="Oops, something went wrong. Try refreshing the page?")
+    if result is not None:
+      clusters, last_cache_time = result
+      next_refresh = last_cache_time + REFRESH_INTERVAL
+      if time.time() > next_refresh:
+        # Show what we have and bring it up to date in the background
+        await run_blocking(start_refresh, user, engine)
+      # Rendering reads the threads' text from the result store
+      return await run_blocking(render_template, 'tweets.html', clusters=clusters, next_refresh=next_refresh)
+
+    job = await run_blocking(lambda: start_refresh(user, engine).to_json())
+    return await run_blocking(render_template, 'loading.html', job=job)
+
+def latest_job(user_id):
+    return db.session.query(Job).filter_by(user_id=user_id).order_by(Job.id.desc()).first()
+
+def job_status(job):
+    status = job.to_json()
+    if job.error:
+        status['message'] = JOB_ERROR_MSGS[job.error]
+    return status
+
+@app.route('/tweets/status')
+@login_required
+def tweets_status():
+    job = latest_job(current_user.id)
+    if job is None:
+        return jsonify({'status': 'none'})
+    return jsonify(job_status(job))
+
+def sse(event, data):
+    # Multi-line data has to be split across data: fields
+    lines = '\n'.join(f'data: {line}' for line in data.split('\n'))
+    return f'event: {event}\n{lines}\n\n'
+
+@app.route('/tweets/stream')
+@login_required
+def tweets_stream():
+    """Server-sent events: clusters as they are summarized, then progress until the job ends."""
+    user_id = current_user.id
+
+    def events():
+        sent = 0
+        last_status = None
+        last_write = time.time()
+        while True:
+            job = latest_job(user_id)
+            if job is None:
+                yield sse('failed', JOB_ERROR_MSGS['stale'])
+                return
+            job_id, job_state, status = job.id, job.status, job_status(job)
+            # End the transaction before writing or sleeping, so an open
+            # stream doesn't hold a pooled connection for the whole job.
+            # It also expires the job, so the next poll reads it afresh
+            db.session.rollback()
+
+            fragments = job_fragments.get(job_id, [])
+            for fragment in fragments[sent:]:
+                yield sse('cluster', fragment)
+                last_write = time.time()
+            sent = len(fragments)
+
+            if status != last_status:
+                yield sse('progress', json.dumps(status))
+                last_status = status
+                last_write = time.time()
+            elif time.time() - last_write > STREAM_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_write = time.time()
+            if job_state == 'done':
+                yield sse('done', '')
+                return
+            if job_state == 'failed':
+                yield sse('failed', status['message'])
+                return
+            time.sleep(STREAM_POLL_SECONDS)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+def admin_authorized():
+    # Admin endpoints are off unless ADMIN_TOKEN is set
+    token = environ.get('ADMIN_TOKEN')
+    if not token:
+        return False
+    given = request.headers.get('Authorization', '').removeprefix('Bearer ') or request.args.get('token', '')
+    return hmac.compare_digest(given.encode(), token.encode())
+
+SHARED_THREADS = metrics.Gauge('shared_threads', 'Thread sharing across users, from the result store.')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """This worker's metrics, in the Prometheus text format."""
+    if not admin_authorized():
+        return 'Not found', 404
+    for name, value in get_store().dedup_stats().items():
+        SHARED_THREADS.set(value, stat=name)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/traces')
+def admin_traces():
+    """Recent pipeline runs on this worker, newest first."""
+    if not admin_authorized():
+        return 'Not found', 404
+    return jsonify([trace.summary() for trace in reversed(metrics.recent_traces)])
+
+@app.route('/admin/traces/<trace_id>')
+def admin_trace(trace_id):
+    """One run in full: stage spans, token usage and every LLM call."""
+    trace = metrics.find_trace(trace_id) if admin_authorized() else None
+    if trace is None:
+        return 'Not found', 404
+    return jsonify(trace.to_dict())
+
+@app.route('/admin/hedging')
+def admin_hedging():
+    """Hedge delays, budget and outcomes per model and stage on this worker."""
+    if not admin_authorized():
+        return 'Not found', 404
+    return jsonify(get_hedger().stats())
+
+# WsgiToAsgi runs every request on one shared thread, so a slow query or an
+# open /tweets/stream held up the whole worker. Run them on a pool instead.
+wsgi_pool = ThreadPoolExecutor(max_workers=int(environ.get('WSGI_THREADS', 32)), thread_name_prefix='wsgi')
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = SyncToAsync(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False, executor=wsgi_pool)
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application)(scope, receive, send)
+
+asgi_app = PooledWsgiToAsgi(app)
@@ -0,0 +1,155 @@
+"""Refreshes many users' timelines in one go, e.g. nightly.
+
+Each user goes through the same stages as a refresh in the app (see
+pipeline.iter_refresh). LLM calls for every user share this process's event
+loop and request scheduler, so they're rate limited and batched together.
+The embedding engine's clustering is CPU bound and only needs the threads,
+so it goes to a process pool; grouping and meta-clustering are quick and
+work on the user's state in place, so they stay here. Results are written
+to the result store from a thread.
+
+Usage:
+  python batch.py --users all
+  python batch.py --users 3,17,42 --concurrency 32
+  python batch.py --timelines tweets.pkl other_timeline.pkl
+
+Timelines are pickled lists of Threads, stored under their file name as
+the user id. They're snapshots, so they're always clustered from scratch.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import environ
+from dotenv import load_dotenv
+import openai
+from pipeline import iter_refresh, timeline_fetcher
+from result_store import get_store
+from metrics import start_trace
+
+
+class Batch:
+  def __init__(self, pool, engine="llm", concurrency=16, batched=True):
+    self.pool = pool
+    self.engine = engine
+    self.batched = batched
+    # Users in flight at once. Their LLM calls all queue on the one scheduler
+    self.concurrency = concurrency
+    self.results = []
+
+  async def refresh(self, user_id, fetch, state, now, trace):
+    """Clusters, summarizes and stores one user's threads. state makes it incremental."""
+    clusters = None
+    async for event, payload in iter_refresh(fetch, engine=self.engine, batched=self.batched, state=state,
+                                             trace=trace, now=now, executor=self.pool):
+      if event == "done":
+        clusters, state = payload
+    await asyncio.get_running_loop().run_in_executor(None, get_store().save, user_id, clusters, state)
+    return len(clusters)
+
+  async def run_user(self, user_id, load):
+    """load() returns (fetch, state, now) for the user, where fetch(since_id)
+    returns their threads."""
+    trace = start_trace(user_id=user_id, engine=self.engine, reason='batch')
+    status = "failed"
+    result = {"user_id": user_id}
+    try:
+      fetch, state, now = await load()
+      result["clusters"] = await self.refresh(user_id, fetch, state, now, trace)
+      result["threads"] = trace.counts.get('fetched_threads', 0)
+      status = "done"
+    except Exception as e:
+      print(f"Refreshing {user_id} failed: {e}")
+      result["error"] = str(e)
+    finally:
+      # iter_refresh finishes the trace, unless we failed before it started
+      if trace.status == 'running':
+        trace.finish(status)
+    result.update(status=status, seconds=round(trace.seconds, 2), cost=round(trace.cost, 4),
+                  llm_calls=trace.counts.get('llm_calls', 0))
+    self.results.append(result)
+    return result
+
+  async def run(self, jobs):
+    """Runs (user_id, load) jobs, self.concurrency at a time."""
+    pending = iter(jobs)
+
+    async def worker():
+      for user_id, load in pending:
+        result = await self.run_user(user_id, load)
+        print(json.dumps(result))
+
+    await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+    return self.results
+
+
+def timeline_jobs(paths):
+  for path in paths:
+    async def load(path=path):
+      with open(path, 'rb') as file_:
+        threads = pickle.load(file_)
+      async def fetch(since_id):
+        return threads
+      # A snapshot: keep every thread, however old
+      created = [t.created_at for t in threads if t.created_at]
+      return fetch, None, max(created, default=None)
+    yield os.path.splitext(os.path.basename(path))[0], load
+
+
+def user_jobs(user_ids):
+  from app import app, User
+  with app.app_context():
+    query = User.query.filter(User.access_token.isnot(None))
+    if user_ids != "all":
+      query = query.filter(User.id.in_([int(i) for i in user_ids.split(",")]))
+    users = [(user.id, user.access_token, user.access_token_secret) for user in query]
+
+  for user_id, access_token, access_token_secret in users:
+    async def load(user_id=user_id, access_token=access_token, access_token_secret=access_token_secret):
+      state = await asyncio.get_running_loop().run_in_executor(None, get_store().load_state, user_id)
+      return timeline_fetcher(access_token, access_token_secret), state, None
+    yield user_id, load
+
+
+def summarize(results, elapsed):
+  done = [r for r in results if r["status"] == "done"]
+  threads = sum(r.get("threads", 0) for r in done)
+  return {
+    "users": len(results),
+    "failed": len(results) - len(done),
+    "seconds": round(elapsed, 2),
+    "users_per_minute": round(len(done) / elapsed * 60, 1) if elapsed else 0,
+    "threads_per_second": round(threads / elapsed, 1) if elapsed else 0,
+    "llm_calls": sum(r["llm_calls"] for r in results),
+    "cost": round(sum(r["cost"] for r in results), 4),
+  }
+
+
+def main():
+  load_dotenv()
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument("--users", help="'all', or comma separated user ids from the app database")
+  source.add_argument("--timelines", nargs="+", help="pickled lists of Threads")
+  parser.add_argument("--engine", default=environ.get('CLUSTERING_ENGINE', 'llm'), choices=["llm", "embedding"])
+  parser.add_argument("--concurrency", type=int, default=16, help="users refreshed at once")
+  parser.add_argument("--processes", type=int, default=os.cpu_count(), help="process pool size for embedding clustering")
+  args = parser.parse_args()
+
+  openai.api_key = environ.get('OPENAI_API_KEY')
+  jobs = list(user_jobs(args.users) if args.users else timeline_jobs(args.timelines))
+  # Spawned rather than forked: the parent has sqlite connections and threads
+  with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+    start = time.perf_counter()
+    results = asyncio.run(Batch(pool, args.engine, args.concurrency,
+                                environ.get('HASHTAG_BATCHING', '1') == '1').run(jobs))
+    elapsed = time.perf_counter() - start
+  print(json.dumps(summarize(results, elapsed)))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,146 @@
+"""Checks group_threads and meta_cluster against the original Counter and
+set based loops.
+
+The original group_threads iterated Python sets, so its tie-breaking
+depended on memory layout. The reference copy below breaks ties by input
+position instead, which is the order the incidence matrix uses.
+
+Run from the repo root:
+  python -m benchmarks.clustering_regression
+"""
+import pickle
+import random
+import time
+from clustering import HashtagsThread, TweetCluster, count_hashtags, group_threads, meta_cluster
+from twitter import Thread
+
+
+def reference_pack_cluster(relevant_threads, threads, hashtag, position):
+  all_cluster_hashtags = count_hashtags(sorted(relevant_threads, key=position.get))
+  pivot_hashtags = set([hashtag])
+  while len(relevant_threads) < 7:
+    found = False
+    for c_hashtag, _ in all_cluster_hashtags.most_common():
+      candidates = [thread for thread in threads if c_hashtag in thread.hashtags]
+      if not candidates:
+        continue
+
+      found = True
+      another_relevant_thread = min(candidates, key=position.get)
+      pivot_hashtags.add(c_hashtag)
+      relevant_threads.add(another_relevant_thread)
+      threads.remove(another_relevant_thread)
+      break
+
+    if not found:
+      break
+
+  all_cluster_hashtags = count_hashtags(relevant_threads)
+  pivot_hashtags.update([h for h, count in all_cluster_hashtags.most_common()
+                         if count > len(relevant_threads) / 2])
+  return pivot_hashtags
+
+
+def reference_group_threads(threads):
+  position = {thread: i for i, thread in enumerate(threads)}
+  hashtag_counter = count_hashtags(threads)
+
+  clusters = []
+  threads = set(threads)
+  for hashtag, _ in hashtag_counter.most_common():
+    relevant_threads = set([thread for thread in threads if hashtag in thread.hashtags])
+    if len(relevant_threads) < 8:
+      threads = threads - relevant_threads
+      pivot_hashtags = reference_pack_cluster(relevant_threads, threads, hashtag, position)
+      if len(relevant_threads) > 3:
+        clusters.append(TweetCluster(relevant_threads, hashtags=pivot_hashtags))
+      else:
+        threads.update(relevant_threads)
+
+  misc = []
+  for thread in threads:
+    found = False
+    for c in clusters:
+      for t in c.threads:
+        found = found or thread.conversation_id == t.conversation_id
+    if not found:
+      misc.append(thread)
+  clusters.append(TweetCluster(misc, hashtags=[], summary="misc"))
+
+  return clusters
+
+
+def reference_meta_cluster(clusters):
+  hashtag_counter = count_hashtags(clusters)
+  meta_clusters = []
+  clusters = set(clusters)
+  for hashtag, _ in hashtag_counter.most_common():
+    relevant_clusters = set([c for c in clusters if hashtag in c.hashtags])
+    clusters -= relevant_clusters
+    if len(relevant_clusters) == 1:
+      meta_clusters.append(list(relevant_clusters)[0])
+    elif len(relevant_clusters) > 1:
+      meta_cluster_hashtags = count_hashtags(relevant_clusters)
+      meta_cluster_pivot_hashtags = [h for h, count in meta_cluster_hashtags.most_common()
+                            if count > len(relevant_clusters) / 2]
+      meta_clusters.append(TweetCluster([], hashtags=meta_cluster_pivot_hashtags, subclusters=relevant_clusters))
+
+  return meta_clusters
+
+
+def signature(clusters):
+  return sorted((sorted(id(t) for t in c.threads), sorted(c.hashtags)) for c in clusters)
+
+
+def meta_signature(meta_clusters):
+  return [(signature(c.subclusters) if c.subclusters else signature([c]), sorted(c.hashtags))
+          for c in meta_clusters]
+
+
+def synthetic_threads(seed_threads, n, rng):
+  vocab = sorted(set(h for t in seed_threads for h in t.hashtags))
+  threads = []
+  for i in range(n):
+    seed = rng.choice(seed_threads)
+    # Keep most of a real thread's hashtags, namespaced into timeline-sized
+    # shards so hashtag frequencies look like a real timeline's
+    shard = i // len(seed_threads)
+    hashtags = [f'{h}_{shard}' for h in seed.hashtags if rng.random() < 0.7] + rng.sample(vocab, 3)
+    threads.append(HashtagsThread(Thread(seed.text, i, [i]), hashtags))
+  return threads
+
+
+def compare(name, threads, run_reference=True):
+  start = time.perf_counter()
+  clusters = group_threads(threads)
+  elapsed = time.perf_counter() - start
+  start = time.perf_counter()
+  meta_clusters = meta_cluster(clusters[:-1])
+  meta_elapsed = time.perf_counter() - start
+  line = (f"{name}: {len(threads)} threads, {len(clusters)} clusters, {len(meta_clusters)} meta clusters, "
+          f"matrix {elapsed * 1000:.1f}ms + {meta_elapsed * 1000:.1f}ms")
+  if run_reference:
+    start = time.perf_counter()
+    expected = reference_group_threads(threads)
+    expected_meta = reference_meta_cluster(clusters[:-1])
+    reference_elapsed = time.perf_counter() - start
+    assert signature(clusters) == signature(expected), f"{name}: clusters differ from the reference"
+    assert meta_signature(meta_clusters) == meta_signature(expected_meta), f"{name}: meta clusters differ from the reference"
+    line += f", reference {reference_elapsed * 1000:.1f}ms, identical"
+  print(line)
+
+
+def main():
+  with open('hashtag_threads.pkl', 'rb') as file_:
+    threads = pickle.load(file_)
+  compare('hashtag_threads.pkl', threads)
+
+  rng = random.Random(0)
+  for n in [500, 2000]:
+    compare(f'synthetic x{n}', synthetic_threads(threads, n, rng))
+  for n in [10000, 20000]:
+    compare(f'synthetic x{n}', synthetic_threads(threads, n, rng), run_reference=False)
+
+
+if __name__ == '__main__':
+  main()
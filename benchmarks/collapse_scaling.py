@@ -0,0 +1,141 @@
+"""Benchmarks ThreadCollapser against the original collapsing loop.
+
+The original looked up every retweet with a linear scan over the included
+tweets and deduplicated replies with a substring search over the thread so
+far, which is quadratic in thread length. ThreadCollapser keeps that
+substring check, appends in place, and once a thread has been searched
+enough to pay for it, rules most tweets out from an index of it. Both
+are run on synthetic timelines with long reply chains, including replies
+that are fragments of the thread, and the results are checked to be
+identical.
+
+Run from the repo root:
+  python -m benchmarks.collapse_scaling
+"""
+import random
+import re
+import time
+from types import SimpleNamespace
+from twitter import Thread, ThreadCollapser
+
+
+def reference_expand_retweets(tweet, include_tweets):
+  tweet_text = re.sub(r'\bRT\b.*', '', tweet.text)
+  if not tweet.referenced_tweets:
+    return tweet_text, [tweet.id]
+  retweet_id = tweet.referenced_tweets[0].id
+  retweet = next((retweet for retweet in include_tweets if retweet.id == retweet_id), None)
+  if retweet:
+    expanded_text, expanded_ids = reference_expand_retweets(retweet, include_tweets)
+    return tweet_text + f"<RETWEET>\n{expanded_text}\n</RETWEET>", [tweet.id, *expanded_ids]
+  return tweet_text, [tweet.id]
+
+
+def reference_collapse(tweets, include_tweets):
+  collapsed_tweets = {}
+  convo_thread_ids = {}
+  for tweet in tweets:
+    expanded_text, thread_ids = reference_expand_retweets(tweet, include_tweets)
+    if tweet.conversation_id in collapsed_tweets:
+      if expanded_text not in collapsed_tweets[tweet.conversation_id]:
+        collapsed_tweets[tweet.conversation_id] += "\n" + expanded_text
+      convo_thread_ids[tweet.conversation_id].extend(thread_ids)
+    else:
+      collapsed_tweets[tweet.conversation_id] = expanded_text
+      convo_thread_ids[tweet.conversation_id] = thread_ids
+  return [Thread(text, convo_id, convo_thread_ids[convo_id]) for convo_id, text in collapsed_tweets.items()]
+
+
+def make_tweet(tweet_id, text, conversation_id, retweet_id=None):
+  referenced = [SimpleNamespace(id=retweet_id, type="retweeted")] if retweet_id else None
+  return SimpleNamespace(id=tweet_id, text=text, conversation_id=conversation_id,
+                         referenced_tweets=referenced, created_at=None)
+
+
+def synthetic_timeline(num_tweets, chain_length, rng):
+  """Reply chains of chain_length tweets, sprinkled with retweets.
+
+  Some retweets quote an earlier tweet of the same chain, some are
+  repeated verbatim, and some point at tweets that weren't included. Some
+  replies are fragments of the chain so far, sometimes spanning two
+  tweets, which the substring check drops.
+  """
+  words = "model paper data training release benchmark open weights eval scaling".split()
+  tweets = []
+  included = []
+  next_id = 0
+  while len(tweets) < num_tweets:
+    conversation_id = next_id
+    chain = []
+    for _ in range(chain_length):
+      next_id += 1
+      roll = rng.random()
+      if chain and roll < 0.1:
+        # Retweet of an earlier tweet in the same conversation
+        original = rng.choice(chain)
+        tweet = make_tweet(next_id, f"RT @someone: {original.text}", conversation_id, original.id)
+      elif roll < 0.2:
+        next_id += 1
+        original = make_tweet(next_id, " ".join(rng.choices(words, k=12)) + f" #{next_id}", next_id)
+        included.append(original)
+        tweet = make_tweet(next_id - 1, f"RT @other: {original.text}", conversation_id, original.id)
+      elif roll < 0.25:
+        # Retweet whose original wasn't included
+        tweet = make_tweet(next_id, "RT @gone: deleted", conversation_id, -next_id)
+      elif chain and roll < 0.3:
+        # The API sometimes repeats a tweet
+        tweet = rng.choice(chain)
+      elif chain and roll < 0.35:
+        i = rng.randrange(len(chain))
+        text = chain[i].text if rng.random() < 0.8 or i + 1 == len(chain) else chain[i].text + "\n" + chain[i + 1].text
+        start = rng.randint(0, len(text))
+        tweet = make_tweet(next_id, text[start:rng.randint(start, len(text))], conversation_id)
+      else:
+        tweet = make_tweet(next_id, " ".join(rng.choices(words, k=20)) + f" ({next_id})", conversation_id)
+      chain.append(tweet)
+    tweets.extend(chain)
+  return tweets[:num_tweets], included
+
+
+def check_overlaps():
+  """Replies that are substrings of the thread, but not of any one tweet in it, are still dropped."""
+  tweets = [make_tweet(1, "Great game tonight everyone", 10), make_tweet(2, "game tonight", 10),
+            make_tweet(3, "Great", 10), make_tweet(4, "everyone\nGreat game", 10), make_tweet(5, "", 10),
+            make_tweet(6, "ni", 10), make_tweet(7, "tonight everyone!", 10), make_tweet(8, "t everyone\nto", 10)]
+  collapser = ThreadCollapser()
+  collapser.add_page(tweets, [])
+  threads = collapser.threads()
+  expected = reference_collapse(tweets, [])
+  assert [(t.text, t.thread_ids) for t in threads] == [(t.text, t.thread_ids) for t in expected], \
+    "overlapping replies collapse differently from the reference"
+  print(f"overlapping replies: {threads[0].text!r}, identical")
+
+
+def run(num_tweets, chain_length, rng, run_reference=True):
+  tweets, included = synthetic_timeline(num_tweets, chain_length, rng)
+  start = time.perf_counter()
+  collapser = ThreadCollapser()
+  collapser.add_page(tweets, included)
+  threads = collapser.threads()
+  elapsed = time.perf_counter() - start
+  line = f"{num_tweets} tweets, chains of {chain_length}: collapser {elapsed * 1000:.1f}ms"
+  if run_reference:
+    start = time.perf_counter()
+    expected = reference_collapse(tweets, included)
+    reference_elapsed = time.perf_counter() - start
+    assert [(t.text, t.conversation_id, t.thread_ids) for t in threads] == \
+      [(t.text, t.conversation_id, t.thread_ids) for t in expected], "collapsed threads differ from the reference"
+    line += f", reference {reference_elapsed * 1000:.1f}ms, identical"
+  print(line)
+
+
+def main():
+  check_overlaps()
+  rng = random.Random(0)
+  for num_tweets, chain_length in [(1000, 10), (5000, 100), (10000, 1000), (20000, 5000)]:
+    run(num_tweets, chain_length, rng)
+  run(200000, 5000, rng, run_reference=False)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,185 @@
+"""A local stand-in for the OpenAI chat completions endpoint.
+
+Answers the app's hashtag, summary, meta-summary (separate or joint) and
+resummary prompts from the bundled fixtures (hashtag_threads.pkl,
+summaries.pkl, meta_summaries.pkl), so the whole pipeline runs without
+network or API keys. Latency, server errors and 429s are configurable and
+drawn from a seeded generator.
+
+Synthetic timelines (see synthetic_threads) prefix each copy of a fixture
+thread with "[<copy>] "; the server answers those with the fixture's
+hashtags suffixed by the copy number, so copies cluster among themselves.
+
+Point openai at it with openai.api_base = "http://127.0.0.1:<port>/v1", or
+run it on its own:
+  python -m benchmarks.fake_openai --port 8001 --latency 0.5 --rate-limit-rate 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import pickle
+import random
+import re
+from collections import Counter
+from aiohttp import web
+from twitter import Thread
+
+COPY_MARKER = re.compile(r'^\[(\d+)\] ')
+COPY_SUFFIX = re.compile(r'_\d+$')
+# Enough of a thread's start to recognise it, even once the prompt truncates it
+MATCH_CHARS = 100
+
+
+def synthetic_threads(threads, scale):
+  """scale copies of the fixture threads, with distinct text and ids per copy."""
+  copies = []
+  for copy in range(scale):
+    for i, thread in enumerate(threads):
+      text = thread.text if copy == 0 else f"[{copy}] {thread.text}"
+      offset = copy * 10 ** 12
+      copies.append(Thread(text, thread.conversation_id + offset,
+                           [int(tweet_id) + offset for tweet_id in thread.thread_ids], thread.created_at))
+  return copies
+
+
+class Fixtures:
+  def __init__(self, hashtag_threads, summaries, meta_summaries):
+    self.hashtags = {t.text[:MATCH_CHARS]: t.hashtags for t in hashtag_threads}
+    self.summaries = [(set(c.hashtags), c.summary.strip()) for c in summaries if c.hashtags]
+    self.meta_summaries = [c.summary.strip() for c in meta_summaries]
+    self.subsummaries = [s.summary.strip() for c in meta_summaries for s in c.subclusters] or self.meta_summaries
+
+  @classmethod
+  def load(cls):
+    fixtures = []
+    for name in ('hashtag_threads.pkl', 'summaries.pkl', 'meta_summaries.pkl'):
+      with open(name, 'rb') as file_:
+        fixtures.append(pickle.load(file_))
+    return cls(*fixtures)
+
+  def thread_hashtags(self, text):
+    text = text.strip()
+    copy = 0
+    match = COPY_MARKER.match(text)
+    if match:
+      copy = int(match[1])
+      text = text[match.end():]
+    hashtags = self.hashtags.get(text[:MATCH_CHARS])
+    if hashtags is None:
+      # Not a fixture thread: make up a stable handful from its words
+      words = re.findall(r'[a-z]{5,}', text.lower())
+      hashtags = sorted(set(f"#{w}" for w in words), key=lambda h: hashlib.md5(h.encode()).digest())[:6]
+    return [f"{h}_{copy}" if copy else h for h in hashtags]
+
+  def summary(self, hashtags, key):
+    base = set(COPY_SUFFIX.sub('', h) for h in hashtags)
+    best = max(self.summaries, key=lambda pair: len(pair[0] & base), default=None)
+    if best is None or not best[0] & base:
+      return self.meta_summaries[key % len(self.meta_summaries)]
+    return best[1]
+
+
+def answer(prompt, fixtures):
+  """What the model would say to prompt, in the format the app parses."""
+  key = int(hashlib.md5(prompt.encode()).hexdigest(), 16)
+  if prompt.startswith('TWEET:\n'):
+    return " ".join(fixtures.thread_hashtags(prompt[len('TWEET:\n'):].split('\n\nGenerate 30')[0]))
+  if prompt.startswith('TWEET 0:\n'):
+    tweets = prompt.split('\n\nGenerate 30')[0]
+    parts = re.split(r'(?:^|\n\n)TWEET (\d+):\n', tweets)
+    return "\n".join(f"TWEET {parts[i]}: " + " ".join(fixtures.thread_hashtags(parts[i + 1]))
+                     for i in range(1, len(parts), 2))
+  if 'Answer with JSON only' in prompt:
+    num_tweets = re.search(r'must begin with "(\d+) tweets are about"', prompt)[1]
+    subclusters = re.findall(r'^SUBCLUSTER (\S+) \((\d+) tweets', prompt, re.M)
+    return json.dumps({
+      "theme": f"{num_tweets} tweets are about {fixtures.meta_summaries[key % len(fixtures.meta_summaries)]}",
+      "subclusters": {label: f"{count} are about {fixtures.subsummaries[(key + i) % len(fixtures.subsummaries)]}"
+                      for i, (label, count) in enumerate(subclusters)},
+    })
+  if 'More specifically,' in prompt:
+    start = re.search(r'must begin with "(.*)"', prompt)[1]
+    return f"{start} {fixtures.subsummaries[key % len(fixtures.subsummaries)]}"
+  num_tweets = re.search(r'must begin with "(\d+) tweets are about"', prompt)
+  num_tweets = num_tweets[1] if num_tweets else "Some"
+  if 'What common theme unites' in prompt:
+    return f"TOPIC: {num_tweets} tweets are about {fixtures.meta_summaries[key % len(fixtures.meta_summaries)]}"
+  related = re.search(r'must be related to (.*)', prompt)
+  hashtags = related[1].split() if related else []
+  return f"TOPIC: {num_tweets} tweets are about {fixtures.summary(hashtags, key)}"
+
+
+def make_app(fixtures, latency=0.0, jitter=0.5, error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, seed=0):
+  rng = random.Random(seed)
+  stats = Counter()
+
+  def error(status, message, headers=None):
+    body = {"error": {"message": message, "type": "server_error" if status >= 500 else "requests", "param": None, "code": None}}
+    return web.json_response(body, status=status, headers=headers)
+
+  async def chat_completions(request):
+    body = await request.json()
+    stats["requests"] += 1
+    # Lognormal around latency, like real completion times
+    await asyncio.sleep(latency * rng.lognormvariate(0, jitter) if latency else 0)
+    roll = rng.random()
+    if roll < rate_limit_rate:
+      stats["rate_limited"] += 1
+      return error(429, "Rate limit reached for requests", {"Retry-After": str(retry_after)})
+    if roll < rate_limit_rate + error_rate:
+      stats["errors"] += 1
+      return error(500, "The server had an error while processing your request.")
+    prompt = body["messages"][-1]["content"]
+    text = answer(prompt, fixtures)
+    stats["ok"] += 1
+    return web.json_response({
+      "id": f"chatcmpl-{stats['requests']}",
+      "object": "chat.completion",
+      "model": body["model"],
+      "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+      "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4,
+                "total_tokens": (len(prompt) + len(text)) // 4},
+    })
+
+  app = web.Application(client_max_size=16 * 1024 ** 2)
+  app["stats"] = stats
+  app.router.add_post("/v1/chat/completions", chat_completions)
+  return app
+
+
+async def start_server(fixtures, port=0, **options):
+  """Returns (runner, api_base, stats)."""
+  app = make_app(fixtures, **options)
+  runner = web.AppRunner(app)
+  await runner.setup()
+  site = web.TCPSite(runner, "127.0.0.1", port)
+  await site.start()
+  port = runner.addresses[0][1]
+  return runner, f"http://127.0.0.1:{port}/v1", app["stats"]
+
+
+def add_server_arguments(parser):
+  parser.add_argument("--latency", type=float, default=0.5, help="median seconds per completion")
+  parser.add_argument("--jitter", type=float, default=0.5, help="lognormal sigma around the latency")
+  parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+  parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with a 429")
+  parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on 429s")
+  parser.add_argument("--seed", type=int, default=0)
+
+
+def server_options(args):
+  return dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+              rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, seed=args.seed)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--port", type=int, default=8001)
+  add_server_arguments(parser)
+  args = parser.parse_args()
+  web.run_app(make_app(Fixtures.load(), **server_options(args)), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,147 @@
+"""A local stand-in for the Twitter v2 home timeline endpoint.
+
+Serves a synthetic timeline built from tweets.pkl, with reverse chronological
+pagination, retweet expansions and a configurable per-page latency. Point the
+app or fetch_tweets_async at it with TWITTER_API_BASE=http://127.0.0.1:<port>.
+
+Run from the repo root to benchmark the paginated fetcher:
+  python -m benchmarks.fake_twitter --scale 10 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import pickle
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+
+
+def synthetic_timeline(threads, scale=1, seed=0):
+  """Returns (tweets, included_tweets) as v2 API JSON, newest first."""
+  rng = random.Random(seed)
+  now = datetime.now(timezone.utc)
+  tweets = []
+  included = []
+  next_id = 2 * 10 ** 18
+  for copy in range(scale):
+    for thread in threads:
+      conversation_id = str(next_id)
+      # Split each thread back into a chain of replies
+      segments = [s for s in thread.text.split("\n\n") if s.strip()] or [thread.text]
+      for segment in segments:
+        tweet = {
+          "id": str(next_id),
+          "text": segment,
+          "conversation_id": conversation_id,
+          "author_id": str(rng.randrange(10 ** 6)),
+          "created_at": (now - timedelta(seconds=rng.randrange(23 * 60 * 60))).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+          "edit_history_tweet_ids": [str(next_id)],
+        }
+        next_id += 1
+        if rng.random() < 0.2:
+          original = {
+            "id": str(next_id),
+            "text": f"original tweet {next_id} about {segment[:40]}",
+            "conversation_id": str(next_id),
+            "author_id": str(rng.randrange(10 ** 6)),
+            "edit_history_tweet_ids": [str(next_id)],
+          }
+          next_id += 1
+          included.append(original)
+          tweet["text"] = f"RT @someone: {original['text']}"
+          tweet["referenced_tweets"] = [{"type": "retweeted", "id": original["id"]}]
+        tweets.append(tweet)
+  tweets.sort(key=lambda t: t["created_at"], reverse=True)
+  return tweets, included
+
+
+def make_app(tweets, included, latency=0.0, page_limit=100):
+  included_by_id = {t["id"]: t for t in included}
+
+  async def me(request):
+    return web.json_response({"data": {"id": "42", "name": "fake", "username": "fake"}})
+
+  async def home_timeline(request):
+    await asyncio.sleep(latency)
+    max_results = min(int(request.query.get("max_results", 100)), page_limit)
+    offset = int(request.query.get("pagination_token", 0))
+    since_id = request.query.get("since_id")
+    candidates = tweets
+    if since_id:
+      candidates = [t for t in tweets if int(t["id"]) > int(since_id)]
+    page = candidates[offset:offset + max_results]
+    meta = {"result_count": len(page)}
+    if page:
+      meta["newest_id"] = max(page, key=lambda t: int(t["id"]))["id"]
+      meta["oldest_id"] = min(page, key=lambda t: int(t["id"]))["id"]
+    if offset + max_results < len(candidates):
+      meta["next_token"] = str(offset + max_results)
+    body = {"meta": meta}
+    if page:
+      body["data"] = page
+      refs = [included_by_id[r["id"]] for t in page for r in t.get("referenced_tweets", []) if r["id"] in included_by_id]
+      if refs:
+        body["includes"] = {"tweets": refs}
+    return web.json_response(body)
+
+  app = web.Application()
+  app.router.add_get("/2/users/me", me)
+  app.router.add_get("/2/users/{id}/timelines/reverse_chronological", home_timeline)
+  return app
+
+
+async def start_server(tweets, included, latency=0.0, port=0):
+  runner = web.AppRunner(make_app(tweets, included, latency))
+  await runner.setup()
+  site = web.TCPSite(runner, "127.0.0.1", port)
+  await site.start()
+  port = runner.addresses[0][1]
+  return runner, f"http://127.0.0.1:{port}"
+
+
+def expected_threads(tweets, included):
+  """Collapses the whole timeline in one go, as a single unpaginated response would."""
+  from tweepy import Tweet
+  from twitter import ThreadCollapser
+  collapser = ThreadCollapser()
+  collapser.add_page([Tweet(t) for t in tweets], [Tweet(t) for t in included])
+  return collapser.threads()
+
+
+async def benchmark(scale, latency, max_results):
+  from twitter import fetch_tweets_async
+  with open('tweets.pkl', 'rb') as file_:
+    threads = pickle.load(file_)
+  tweets, included = synthetic_timeline(threads, scale)
+  runner, api_base = await start_server(tweets, included, latency)
+  os.environ['TWITTER_API_BASE'] = api_base
+  # OAuth 1.0a signs every request, so it needs some consumer credentials
+  os.environ.setdefault('TWITTER_API_KEY', 'fake')
+  os.environ.setdefault('TWITTER_API_SECRET', 'fake')
+  try:
+    start = time.perf_counter()
+    fetched = await fetch_tweets_async("42-fake", "fake", max_results=max_results, max_pages=10 ** 6)
+    elapsed = time.perf_counter() - start
+  finally:
+    await runner.cleanup()
+
+  expected = expected_threads(tweets, included)
+  assert [(t.text, t.conversation_id, t.thread_ids) for t in fetched] == \
+    [(t.text, t.conversation_id, t.thread_ids) for t in expected], "paginated fetch differs from a single-page fetch"
+  pages = -(-len(tweets) // max_results)
+  print(f"{len(tweets)} tweets in {pages} pages -> {len(fetched)} threads in {elapsed:.2f}s "
+        f"({len(tweets) / elapsed:.0f} tweets/s), matches unpaginated collapse")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--scale", type=int, default=10, help="copies of tweets.pkl in the timeline")
+  parser.add_argument("--latency", type=float, default=0.2, help="seconds per page")
+  parser.add_argument("--max-results", type=int, default=100)
+  args = parser.parse_args()
+  asyncio.run(benchmark(args.scale, args.latency, args.max_results))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,107 @@
+"""Measures the per-user memory of a clustered timeline, before and after the
+slotted Thread/HashtagsThread/TweetCluster classes.
+
+The "before" classes mirror the original dict-backed ones: HashtagsThread
+copied the thread's fields and kept its own list of hashtag strings, as
+parsed from each LLM response. Both representations are built from the same
+synthetic timeline (copies of hashtag_threads.pkl) with the same clusters,
+and measured with tracemalloc. Tweet text is allocated up front and shared,
+since it costs the same either way.
+
+Run from the repo root:
+  python -m benchmarks.memory_footprint
+"""
+import gc
+import pickle
+import tracemalloc
+from clustering import HashtagsThread, TweetCluster, group_threads, meta_cluster
+from twitter import Thread
+
+
+class LegacyThread():
+  def __init__(self, text, conversation_id, thread_ids, created_at=None):
+    self.text = text
+    self.conversation_id = conversation_id
+    self.thread_ids = thread_ids
+    self.created_at = created_at
+
+
+class LegacyHashtagsThread:
+  def __init__(self, thread, hashtags):
+    self.text = thread.text
+    self.conversation_id = thread.conversation_id
+    self.thread_ids = thread.thread_ids
+    self.created_at = thread.created_at
+    self.hashtags = hashtags
+
+
+class LegacyTweetCluster:
+  def __init__(self, threads, hashtags=None, summary=None, subclusters=[]):
+    self.threads = threads
+    self.hashtags = hashtags
+    self.summary = summary
+    self.subclusters = subclusters or []
+
+
+def synthetic_user(seeds, scale):
+  """Returns (text, conversation_id, thread_ids, created_at, hashtag answer) per thread."""
+  rows = []
+  for copy in range(scale):
+    for i, seed in enumerate(seeds):
+      conversation_id = copy * len(seeds) + i
+      # Distinct text per copy, as distinct tweets would have
+      text = f"{seed.text} {copy}"
+      # Suffixed per copy so clusters stay 4-7 threads, like a real timeline
+      answer = " ".join(f"{h}_{copy}" for h in seed.hashtags)
+      rows.append((text, conversation_id, [conversation_id, conversation_id + 1], 1.7e9 + i, answer))
+  return rows
+
+
+def cluster_shape(rows):
+  """Cluster membership as row positions, computed once and reused for both builds."""
+  threads = [HashtagsThread(Thread(*row[:4]), row[4].split()) for row in rows]
+  position = {t.conversation_id: i for i, t in enumerate(threads)}
+  clusters = group_threads(threads)[:-1]
+  meta = meta_cluster(clusters)
+  def shape(cluster):
+    return (sorted(position[t.conversation_id] for t in cluster.threads), sorted(cluster.hashtags),
+            [shape(c) for c in cluster.subclusters])
+  return [shape(c) for c in meta]
+
+
+def build(rows, shapes, thread_cls, hashtags_thread_cls, cluster_cls):
+  # parse_hashtags splits each answer, so every thread gets its own strings
+  threads = [hashtags_thread_cls(thread_cls(*row[:4]), row[4].split()) for row in rows]
+  def make(shape):
+    members, hashtags, subclusters = shape
+    return cluster_cls(set(threads[i] for i in members), hashtags=set(hashtags), summary="summary",
+                       subclusters=[make(s) for s in subclusters])
+  return [make(s) for s in shapes]
+
+
+def measure(rows, shapes, *classes):
+  gc.collect()
+  tracemalloc.start()
+  clusters = build(rows, shapes, *classes)
+  gc.collect()
+  size, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return size, clusters
+
+
+def main():
+  with open('hashtag_threads.pkl', 'rb') as file_:
+    seeds = pickle.load(file_)
+  for scale in [1, 10, 50]:
+    rows = synthetic_user(seeds, scale)
+    shapes = cluster_shape(rows)
+    # Warm the shared vocabulary, it's paid once per process rather than per user
+    build(rows, shapes, Thread, HashtagsThread, TweetCluster)
+    before, _ = measure(rows, shapes, LegacyThread, LegacyHashtagsThread, LegacyTweetCluster)
+    after, _ = measure(rows, shapes, Thread, HashtagsThread, TweetCluster)
+    print(f"{len(rows)} threads: before {before / 1024:.0f}KiB ({before / len(rows):.0f}B/thread), "
+          f"after {after / 1024:.0f}KiB ({after / len(rows):.0f}B/thread), {before / after:.1f}x smaller")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,162 @@
+"""Replays cluster_threads -> summarize_clusters -> meta_cluster -> meta_summarize
+against benchmarks/fake_openai.py, on timelines scaled up from tweets.pkl.
+
+Each scale runs in its own process, so peak memory is per run. Reports
+throughput, per-request latency percentiles as the client saw them
+(including queueing in the scheduler), stage wall times and peak RSS.
+
+The response cache and summary memo are off and the scheduler's per-model
+rate limits are lifted (--rate-limits keeps them), so the numbers measure
+this code and the fake server's latency rather than OpenAI's quotas.
+
+Run from the repo root:
+  python -m benchmarks.pipeline_replay --scales 1,10,100 --latency 0.5
+  python -m benchmarks.pipeline_replay --scales 10 --error-rate 0.05 --rate-limit-rate 0.05
+  LLM_HEDGING=1 python -m benchmarks.pipeline_replay --scales 30 --jitter 1.0
+"""
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import threading
+import time
+from benchmarks.fake_openai import Fixtures, add_server_arguments, server_options, start_server, synthetic_threads
+
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def serve_in_background(fixtures, options):
+  """Runs the fake server on its own loop, so clustering doesn't stall it."""
+  started = threading.Event()
+  server = {}
+
+  def run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server['runner'], server['api_base'], server['stats'] = loop.run_until_complete(start_server(fixtures, **options))
+    started.set()
+    loop.run_forever()
+
+  threading.Thread(target=run, name='fake-openai', daemon=True).start()
+  started.wait()
+  return server['api_base'], server['stats']
+
+
+async def replay(threads):
+  from clustering import cluster_threads, meta_cluster
+  from summary import summarize_clusters
+  from meta_summary import meta_summarize
+  from metrics import start_trace
+
+  trace = start_trace(engine="llm", benchmark="pipeline_replay")
+  trace.start_stage("clustering")
+  clusters = await cluster_threads(threads, batched=True)
+  trace.end_stage("clustering")
+  trace.start_stage("summarizing")
+  summarized = await summarize_clusters(clusters)
+  trace.end_stage("summarizing")
+  trace.start_stage("meta_summarizing")
+  meta_summarized = await meta_summarize(meta_cluster(summarized))
+  trace.end_stage("meta_summarizing")
+  trace.finish("done")
+  return clusters, meta_summarized, trace
+
+
+def run_one(args):
+  os.environ['LLM_CACHE_BACKEND'] = 'none'
+  os.environ['SUMMARY_MEMO'] = '0'
+  import openai
+  import metrics
+  import scheduler
+  # Every call goes into the trace, however many there are
+  metrics.MAX_TRACE_CALLS = sys.maxsize
+  if not args.rate_limits:
+    for model in scheduler.MODEL_LIMITS:
+      scheduler.MODEL_LIMITS[model] = (10 ** 9, 10 ** 12)
+    scheduler.DEFAULT_LIMITS = (10 ** 9, 10 ** 12)
+
+  fixtures = Fixtures.load()
+  with open('tweets.pkl', 'rb') as file_:
+    threads = synthetic_threads(pickle.load(file_), args.scale)
+  openai.api_base, server_stats = serve_in_background(fixtures, server_options(args))
+  openai.api_key = "fake"
+
+  baseline = peak_rss_mb()
+  start = time.perf_counter()
+  clusters, meta_summarized, trace = asyncio.run(replay(threads))
+  elapsed = time.perf_counter() - start
+
+  ok = [call['seconds'] for call in trace.calls if call['outcome'] == 'ok']
+  summaries = [c.summary for c in meta_summarized]
+  return {
+    "scale": args.scale,
+    "threads": len(threads),
+    "clusters": len(clusters) - 1,
+    "meta_clusters": len(meta_summarized),
+    "unparsed": sum(1 for s in summaries if s.startswith("Error parsing")),
+    "seconds": round(elapsed, 2),
+    "threads_per_second": round(len(threads) / elapsed, 1),
+    "requests": len(trace.calls),
+    "requests_per_second": round(len(trace.calls) / elapsed, 1),
+    "p50": round(percentile(ok, 50), 3),
+    "p99": round(percentile(ok, 99), 3),
+    "stages": trace.stage_seconds(),
+    "retries": trace.counts.get('llm_retries', 0),
+    "give_ups": trace.counts.get('llm_give_ups', 0),
+    "hedged": trace.counts.get('llm_hedged', 0),
+    "hedge_wins": trace.counts.get('llm_hedge_won', 0),
+    "server": dict(server_stats),
+    "baseline_rss_mb": round(baseline, 1),
+    "peak_rss_mb": round(peak_rss_mb(), 1),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--scales", default="1,10,100", help="comma separated copies of tweets.pkl")
+  parser.add_argument("--rate-limits", action="store_true", help="keep the scheduler's per-model rate limits")
+  parser.add_argument("--json", action="store_true", help="print one JSON result per scale")
+  parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+  add_server_arguments(parser)
+  args = parser.parse_args()
+
+  if args.scale is not None:
+    print(json.dumps(run_one(args)))
+    return
+
+  for scale in [int(s) for s in args.scales.split(",")]:
+    command = [sys.executable, "-m", "benchmarks.pipeline_replay", "--scale", str(scale),
+               *[f"--{name.replace('_', '-')}={value}" for name, value in server_options(args).items()],
+               *(["--rate-limits"] if args.rate_limits else [])]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    if args.json:
+      print(json.dumps(result))
+      continue
+    stages = " ".join(f"{name} {seconds:.1f}s" for name, seconds in result["stages"].items())
+    print(f"x{scale}: {result['threads']} threads -> {result['clusters']} clusters, {result['meta_clusters']} meta "
+          f"in {result['seconds']:.1f}s ({result['threads_per_second']:.0f} threads/s, "
+          f"{result['requests_per_second']:.0f} requests/s)")
+    print(f"  requests p50 {result['p50']:.2f}s p99 {result['p99']:.2f}s, {result['retries']} retries, "
+          f"{result['give_ups']} given up, {result['hedged']} hedged ({result['hedge_wins']} won), "
+          f"{result['unparsed']} unparsed; {stages}")
+    print(f"  peak RSS {result['peak_rss_mb']:.0f}MB ({result['peak_rss_mb'] - result['baseline_rss_mb']:.0f}MB over "
+          f"{result['baseline_rss_mb']:.0f}MB after imports); server {result['server']}")
+
+
+if __name__ == "__main__":
+  main()
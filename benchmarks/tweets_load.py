@@ -0,0 +1,188 @@
+"""Load test for /tweets on a single uvicorn worker, before and after moving
+blocking calls off the event loop.
+
+"before" serves the app the way it used to be served: WsgiToAsgi runs every
+request on one shared thread, and the async view calls the result store and
+SQLAlchemy on the event loop. "after" is app.asgi_app as it is now.
+
+Users are seeded with stored results from meta_summaries.pkl. --db-latency
+adds a sleep to every result store read, standing in for a networked
+database, and --streams holds /tweets/stream connections open for users
+with a refresh in progress, as the loading page does.
+
+Run from the repo root:
+  python -m benchmarks.tweets_load --concurrency 32 --duration 10 --db-latency 0.02 --streams 2
+"""
+import argparse
+import asyncio
+import os
+import pickle
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+
+
+def free_port():
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def percentile(values, p):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def seed(num_users, num_streams):
+  """Creates users with stored results, plus users mid-refresh for the streams. Returns session cookies."""
+  import app
+  with open('meta_summaries.pkl', 'rb') as file_:
+    clusters = pickle.load(file_)
+  serializer = app.app.session_interface.get_signing_serializer(app.app)
+  cookies = {"pages": [], "streams": []}
+  with app.app.app_context():
+    app.db.create_all()
+    now = time.time()
+    for i in range(num_users + num_streams):
+      user = app.User(username=f"load-{i}", access_token="fake", access_token_secret="fake")
+      app.db.session.add(user)
+      app.db.session.flush()
+      if i < num_users:
+        app.get_store().save(user.id, clusters)
+        kind = "pages"
+      else:
+        app.db.session.add(app.Job(user_id=user.id, active_key=user.id, status='running', stage='clustering',
+                                   percent=40, created_at=now, updated_at=now))
+        kind = "streams"
+      cookies[kind].append(serializer.dumps({'_user_id': str(user.id), '_fresh': True}))
+    app.db.session.commit()
+  return cookies
+
+
+def serve(mode, port, db_latency):
+  import uvicorn
+  import app
+  import result_store
+  if db_latency:
+    load = result_store.ResultStore.load
+    def slow_load(self, user_id):
+      time.sleep(db_latency)
+      return load(self, user_id)
+    result_store.ResultStore.load = slow_load
+
+  asgi = app.asgi_app
+  if mode == "before":
+    async def run_inline(func, *args):
+      return func(*args)
+    app.run_blocking = run_inline
+    asgi = app.WsgiToAsgi(app.app)
+  uvicorn.run(asgi, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def hold_stream(session, url, cookie):
+  try:
+    async with session.get(f"{url}/tweets/stream", cookies={"session": cookie}) as response:
+      async for _ in response.content:
+        pass
+  except (aiohttp.ClientError, asyncio.TimeoutError, asyncio.CancelledError):
+    pass
+
+
+async def load(url, cookies, concurrency, duration, timeout):
+  latencies = []
+  failures = 0
+  timeouts = 0
+  async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as streams_session:
+    streams = [asyncio.ensure_future(hold_stream(streams_session, url, cookie)) for cookie in cookies["streams"]]
+    # Let the streams get going before measuring
+    await asyncio.sleep(0.5)
+    end = time.perf_counter() + duration
+
+    async def worker(session):
+      nonlocal failures, timeouts
+      while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+          async with session.get(f"{url}/tweets", cookies={"session": random.choice(cookies["pages"])},
+                                 allow_redirects=False) as response:
+            await response.read()
+            if response.status == 200:
+              latencies.append(time.perf_counter() - start)
+            else:
+              failures += 1
+        except asyncio.TimeoutError:
+          timeouts += 1
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+      started = time.perf_counter()
+      await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+      elapsed = time.perf_counter() - started
+    for stream in streams:
+      stream.cancel()
+    await asyncio.gather(*streams, return_exceptions=True)
+  return latencies, failures, timeouts, elapsed
+
+
+def wait_until_up(port, process, deadline=30):
+  give_up_at = time.time() + deadline
+  while time.time() < give_up_at:
+    if process.poll() is not None:
+      raise RuntimeError("server exited")
+    try:
+      socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+      return
+    except OSError:
+      time.sleep(0.1)
+  raise RuntimeError("server didn't start")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--concurrency", type=int, default=32, help="clients requesting /tweets in a loop")
+  parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+  parser.add_argument("--users", type=int, default=50)
+  parser.add_argument("--streams", type=int, default=2, help="/tweets/stream connections held open")
+  parser.add_argument("--db-latency", type=float, default=0.02, help="seconds added to every result store read")
+  parser.add_argument("--timeout", type=float, default=10, help="seconds before a request counts as timed out")
+  parser.add_argument("--serve", choices=["before", "after"], help=argparse.SUPPRESS)
+  parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.serve:
+    serve(args.serve, args.port, args.db_latency)
+    return
+
+  workdir = tempfile.mkdtemp(prefix="tweets-load-")
+  os.environ['DATABASE_URL'] = f"sqlite:///{workdir}/app.db"
+  os.environ['RESULT_STORE_PATH'] = f"{workdir}/results.db"
+  cookies = seed(args.users, args.streams)
+
+  for mode in ("before", "after"):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.tweets_load", "--serve", mode, "--port", str(port),
+                               "--db-latency", str(args.db_latency)], env=os.environ.copy())
+    try:
+      wait_until_up(port, server)
+      latencies, failures, timeouts, elapsed = asyncio.run(
+        load(f"http://127.0.0.1:{port}", cookies, args.concurrency, args.duration, args.timeout))
+    finally:
+      server.terminate()
+      try:
+        server.wait(timeout=5)
+      except subprocess.TimeoutExpired:
+        # Stream handlers only notice a closed connection when they next write
+        server.kill()
+        server.wait()
+    print(f"{mode}: {len(latencies) / elapsed:.0f} pages/s, p50 {percentile(latencies, 50) * 1000:.0f}ms "
+          f"p99 {percentile(latencies, 99) * 1000:.0f}ms, {failures} errors, {timeouts} timeouts "
+          f"({args.concurrency} clients, {args.streams} open streams, {args.db_latency * 1000:.0f}ms store reads)")
+
+
+if __name__ == "__main__":
+  main()
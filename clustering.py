@@ -1,43 +1,118 @@
-import openai
 import asyncio
+import sys
+import threading
+import numpy as np
+from scipy import sparse
 from twitter import Thread
+from llm import chat_completion, estimate_text_tokens, truncate_text
+from llm_cache import get_cache
 import re
-import time
 from collections import Counter
 import pickle
 
+class HashtagVocabulary:
+  """Hashtags seen by this process, so each thread only stores integer ids."""
+  def __init__(self):
+    self.words = []
+    self.ids = {}
+    self.lock = threading.Lock()
+
+  def encode(self, hashtags):
+    ids = []
+    for h in hashtags:
+      i = self.ids.get(h)
+      if i is None:
+        with self.lock:
+          i = self.ids.get(h)
+          if i is None:
+            i = len(self.words)
+            self.words.append(sys.intern(h))
+            self.ids[self.words[i]] = i
+      ids.append(i)
+    return np.array(ids, dtype=np.uint32)
+
+  def decode(self, ids):
+    words = self.words
+    return [words[i] for i in ids.tolist()]
+
+VOCABULARY = HashtagVocabulary()
+
 class HashtagsThread:
+  # __weakref__ lets the result store share live threads between users
+  __slots__ = ('thread', 'hashtag_ids', '__weakref__')
+
   def __init__(self, thread, hashtags):
-    self.text = thread.text
-    self.conversation_id = thread.conversation_id
-    self.thread_ids = thread.thread_ids
-    self.hashtags = hashtags
+    # Keep a reference to the underlying thread instead of copying it
+    self.thread = getattr(thread, 'thread', thread)
+    self.hashtag_ids = VOCABULARY.encode(hashtags)
+
+  @property
+  def text(self):
+    return self.thread.text
+
+  @property
+  def conversation_id(self):
+    return self.thread.conversation_id
+
+  @property
+  def thread_ids(self):
+    return self.thread.thread_ids
+
+  @property
+  def created_at(self):
+    return self.thread.created_at
+
+  @property
+  def first_id(self):
+    return self.thread.thread_ids[0]
+
+  @property
+  def hashtags(self):
+    return VOCABULARY.decode(self.hashtag_ids)
+
+  def __getstate__(self):
+    # Vocabulary ids only mean something inside this process
+    return {'thread': self.thread, 'hashtags': self.hashtags}
+
+  def __setstate__(self, state):
+    thread = state.get('thread')
+    if thread is None:
+      # Pickled before threads were referenced rather than copied
+      thread = Thread(state['text'], state['conversation_id'], state['thread_ids'], state.get('created_at'))
+    self.__init__(thread, state['hashtags'])
 
 class TweetCluster:
+  __slots__ = ('threads', 'hashtags', 'summary', 'subclusters', '_num_tweets')
+
   def __init__(self, threads, hashtags=None, summary=None, subclusters=[]):
     self.threads = threads
     self.hashtags = hashtags
     self.summary = summary
     self.subclusters = subclusters or []
+    self._num_tweets = None
 
   @property
   def num_tweets(self):
-    count = len(self.threads)
-    if self.subclusters:
-      for cluster in self.subclusters:
-        count += cluster.num_tweets
-    return count
-
-async def with_retries(func, err_return):
-  for attempt in range(1, 4):  # 3 attempts with exponential backoff
-    try:
-      return await func()
-    except Exception as e:
-      wait_time = 2 ** attempt
-      print(f"Error generating summary on attempt {attempt}. Retrying in {wait_time} seconds. Error: {str(e)}")
-      time.sleep(wait_time)
-  return err_return
-  
+    if self._num_tweets is None:
+      self._num_tweets = len(self.threads) + sum(cluster.num_tweets for cluster in self.subclusters)
+    return self._num_tweets
+
+  def add_thread(self, thread):
+    self.threads.add(thread)
+    self._num_tweets = None
+
+  def __getstate__(self):
+    return {'threads': self.threads, 'hashtags': self.hashtags, 'summary': self.summary,
+            'subclusters': self.subclusters}
+
+  def __setstate__(self, state):
+    self.__init__(state['threads'], state.get('hashtags'), state.get('summary'), state.get('subclusters'))
+
+def stable_order(threads):
+  # Thread sets iterate in memory order. Sort them so the same cluster always
+  # produces the same prompt and can be served from the response cache.
+  return sorted(threads, key=lambda t: t.conversation_id)
+
 HASHTAG_PROMPT = """\
 TWEET:
 {tweet}
@@ -49,28 +124,160 @@ If TWEET refers to a location or event, include at least one hashtag containing
 If TWEET refers to a specific object or thing, include at least one hashtag containing the name of that thing.
 """
 
-async def add_hashtags(thread):
-  # TODO - count tokens
+BATCH_HASHTAG_PROMPT = """\
+{tweets}
+
+Generate 30 possible hashtags that could go with each of the {num_tweets} TWEETs above.
+
+Rules:
+If a TWEET refers to a location or event, include at least one hashtag containing the name of the event.
+If a TWEET refers to a specific object or thing, include at least one hashtag containing the name of that thing.
+
+Answer with one line per TWEET, in this format:
+TWEET <number>: #hashtag1 #hashtag2 ...
+"""
+
+HASHTAG_MODEL = "gpt-3.5-turbo"
+# Keep batches well inside gpt-3.5-turbo's 4k context, counting the answers
+HASHTAG_BATCH_TOKENS = 2500
+HASHTAG_BATCH_SIZE = 15
+TOKENS_PER_HASHTAG_ANSWER = 120
+# Long threads are cut to this many tokens before asking for hashtags
+HASHTAG_THREAD_TOKENS = 1000
+
+
+def hashtag_text(thread):
+  return truncate_text(thread.text, HASHTAG_THREAD_TOKENS, HASHTAG_MODEL)
+
+
+def hashtag_messages(thread):
+  return [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": HASHTAG_PROMPT.format(tweet=hashtag_text(thread))}
+  ]
+
+
+def parse_hashtags(response_text):
+  return [h.lower() for h in re.findall(r'#\w+', response_text)]
+
+
+async def add_hashtags(thread, check_cache=True):
+  """The thread's HashtagsThread, or None if the request failed."""
+  response_text = await chat_completion(HASHTAG_MODEL, hashtag_messages(thread), err_return=None, stage="hashtags",
+                                        check_cache=check_cache)
+  if response_text is None:
+    return None
+  return HashtagsThread(thread, parse_hashtags(response_text))
+
+
+def parse_batch_hashtags(response_text):
+  """Maps each TWEET number in a batched answer to its hashtags."""
+  answers = {}
+  current = None
+  for line in response_text.split("\n"):
+    match = re.match(r'\W*TWEET\s*(\d+)\W*:(.*)', line, re.IGNORECASE)
+    if match:
+      current = int(match[1])
+      answers[current] = parse_hashtags(match[2])
+    elif current is not None:
+      # Some answers wrap onto the following lines
+      answers[current].extend(parse_hashtags(line))
+  return answers
+
+
+def hashtag_batches(threads):
+  batch = []
+  batch_tokens = 0
+  for thread in threads:
+    tokens = estimate_text_tokens(hashtag_text(thread), HASHTAG_MODEL) + TOKENS_PER_HASHTAG_ANSWER
+    if batch and (batch_tokens + tokens > HASHTAG_BATCH_TOKENS or len(batch) == HASHTAG_BATCH_SIZE):
+      yield batch
+      batch = []
+      batch_tokens = 0
+    batch.append(thread)
+    batch_tokens += tokens
+  if batch:
+    yield batch
+
+
+async def add_hashtags_batch(batch):
+  """HashtagsThreads for batch, in order, with None for threads whose requests failed."""
+  tweets = "\n\n".join([f"TWEET {i}:\n{hashtag_text(thread)}" for i, thread in enumerate(batch)])
   messages = [
     {"role": "system", "content": "You are a helpful assistant."},
-    {"role": "user", "content": HASHTAG_PROMPT.format(tweet=thread.text)}
+    {"role": "user", "content": BATCH_HASHTAG_PROMPT.format(tweets=tweets, num_tweets=len(batch))}
   ]
+  response_text = await chat_completion(HASHTAG_MODEL, messages, err_return=None, stage="hashtags")
+  answers = parse_batch_hashtags(response_text) if response_text is not None else {}
+
+  results = [None] * len(batch)
+  for i, thread in enumerate(batch):
+    if answers.get(i):
+      results[i] = HashtagsThread(thread, answers[i])
+
+  # Also cache the answers under the single-thread prompt, so other users'
+  # timelines can reuse them regardless of how their batches are packed
+  cache = get_cache()
+  def cache_answers():
+    for i, thread in enumerate(batch):
+      if answers.get(i):
+        cache.set(HASHTAG_MODEL, hashtag_messages(thread), " ".join(answers[i]))
+  await asyncio.to_thread(cache_answers)
+
+  # Anything the model skipped or mangled, or the whole batch if it failed,
+  # gets its own request. iter_hashtags already found these prompts uncached
+  failed = [i for i, result in enumerate(results) if result is None]
+  retried = await asyncio.gather(*[add_hashtags(batch[i], check_cache=False) for i in failed])
+  for i, hashtag_thread in zip(failed, retried):
+    results[i] = hashtag_thread
+  return results
 
-  async def get_hashtags():
-    print("sending request...")
-    response = await openai.ChatCompletion.acreate(
-      # model="gpt-4",
-      model="gpt-3.5-turbo",
-      messages=messages
-    )
-    response_text = response.choices[0].message['content'].strip()
-    hashtags = re.findall(r'#\w+', response_text)
 
-    return [h.lower() for h in hashtags]
+async def iter_hashtags(threads, batched=False):
+  """Yields lists of (index, HashtagsThread) as hashtags come back, cached ones first.
 
-  hashtags = await with_retries(get_hashtags, [])
+  Threads whose requests failed come back as (index, None), so they aren't
+  mistaken for threads with no hashtags and stored or shared as such.
+  """
+  if not batched:
+    async def indexed(i, thread):
+      return [(i, await add_hashtags(thread))]
+    for next_result in asyncio.as_completed([indexed(i, thread) for i, thread in enumerate(threads)]):
+      yield await next_result
+    return
 
-  return HashtagsThread(thread, hashtags)
+  cache = get_cache()
+  def lookup():
+    return [cache.get(HASHTAG_MODEL, hashtag_messages(thread), "hashtags") for thread in threads]
+  cached = []
+  uncached = []
+  # One trip off the event loop for the whole timeline
+  for i, (thread, response_text) in enumerate(zip(threads, await asyncio.to_thread(lookup))):
+    if response_text is not None:
+      cached.append((i, HashtagsThread(thread, parse_hashtags(response_text))))
+    else:
+      uncached.append(i)
+  if cached:
+    yield cached
+
+  async def indexed_batch(indices):
+    return list(zip(indices, await add_hashtags_batch([threads[i] for i in indices])))
+  batches = []
+  start = 0
+  for batch in hashtag_batches([threads[i] for i in uncached]):
+    batches.append(indexed_batch(uncached[start:start + len(batch)]))
+    start += len(batch)
+  for next_batch in asyncio.as_completed(batches):
+    yield await next_batch
+
+
+async def add_hashtags_batched(threads):
+  """Hashtags many threads per request. Returns HashtagsThreads in input order, None where that failed."""
+  results = [None] * len(threads)
+  async for hashtagged in iter_hashtags(threads, batched=True):
+    for i, hashtag_thread in hashtagged:
+      results[i] = hashtag_thread
+  return results
 
 
 def count_hashtags(threads : HashtagsThread | TweetCluster):
@@ -81,83 +288,160 @@ def count_hashtags(threads : HashtagsThread | TweetCluster):
   return hashtag_counter
 
 
-def pack_cluster(relevant_threads, threads, hashtag):
-  # Grab more threads that seem relevant until we hit 7
-  all_cluster_hashtags = count_hashtags(relevant_threads)
-  pivot_hashtags = set([hashtag])
-  while len(relevant_threads) < 7:
-    found = False
-    for c_hashtag, _ in all_cluster_hashtags.most_common():
-      try:
-        another_relevant_thread = next(iter([thread for thread in threads if c_hashtag in thread.hashtags]))
-      except Exception:
-        continue
-
-      found = True
-      pivot_hashtags.add(c_hashtag)
-      relevant_threads.add(another_relevant_thread)
-      threads.remove(another_relevant_thread)
-      break
+class HashtagMatrix:
+  """Sparse incidence matrix of rows (threads or clusters) by hashtags, built once per run.
 
-    if not found:
-      break
+  Columns are numbered by first appearance, scanning rows in order, so ranking
+  by count and then column matches Counter.most_common's tie-breaking. Rows
+  can be marked assigned; remaining[c] counts the unassigned rows with
+  hashtag c.
+  """
+  def __init__(self, id_lists):
+    lengths = np.array([len(ids) for ids in id_lists], dtype=np.int64)
+    self.indptr = np.zeros(len(id_lists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=self.indptr[1:])
+    flat = np.concatenate(id_lists) if id_lists else np.zeros(0, dtype=np.uint32)
+    ids, first, columns = np.unique(flat, return_index=True, return_inverse=True)
+    by_appearance = np.argsort(first, kind='stable')
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[by_appearance] = np.arange(len(ids))
+    # Vocabulary id of each column
+    self.ids = ids[by_appearance]
+    # Column of each hashtag occurrence, in row order and then answer order
+    self.columns = rank[columns.ravel()]
 
-  # Also add hashtags that most threads have, but were not originally
-  # used to pivot
-  all_cluster_hashtags = count_hashtags(relevant_threads)
-  pivot_hashtags.update([h for h, count in all_cluster_hashtags.most_common()
-                         if count > len(relevant_threads) / 2])
-  return pivot_hashtags
+    shape = (len(id_lists), len(ids))
+    # Repeated hashtags in one answer count twice, as they did with Counter
+    self.counts = sparse.csr_matrix((np.ones(len(flat), dtype=np.int32), self.columns, self.indptr), shape=shape)
+    self.incidence = self.counts.copy()
+    self.incidence.sum_duplicates()
+    self.incidence.data[:] = 1
+    self.postings = self.incidence.tocsc()
+    self.postings.sort_indices()
 
+    self.assigned = np.zeros(shape[0], dtype=bool)
+    self.remaining = np.asarray(self.incidence.sum(axis=0), dtype=np.int64).ravel()
 
-async def cluster_threads(threads):
-  threads = await asyncio.gather(*[add_hashtags(thread) for thread in threads])
-  # with open('hashtag_threads.pkl', 'wb') as file_:
-  #   pickle.dump(threads, file_)
-  # with open('hashtag_threads.pkl', 'rb') as file_:
-  #   threads = pickle.load(file_)
+  def words(self, columns):
+    return VOCABULARY.decode(self.ids[np.asarray(columns, dtype=np.int64)])
+
+  def most_common(self):
+    totals = np.asarray(self.counts.sum(axis=0)).ravel()
+    return np.argsort(-totals, kind='stable')
 
-  hashtag_counter = count_hashtags(threads)
+  def ranked(self, rows):
+    """Columns of the hashtags in rows, most common first, with their counts."""
+    columns = np.concatenate([self.columns[self.indptr[r]:self.indptr[r + 1]] for r in rows])
+    unique, first, counts = np.unique(columns, return_index=True, return_counts=True)
+    order = np.lexsort((first, -counts))
+    return unique[order], counts[order]
+
+  def rows(self, column):
+    return self.postings.indices[self.postings.indptr[column]:self.postings.indptr[column + 1]]
+
+  def unassigned_rows(self, column):
+    rows = self.rows(column)
+    return rows[~self.assigned[rows]]
+
+  def first_unassigned(self, column):
+    rows = self.rows(column)
+    return rows[np.argmax(~self.assigned[rows])]
+
+  def assign(self, rows, assigned=True):
+    rows = np.asarray(rows, dtype=np.int64)
+    self.assigned[rows] = assigned
+    columns = np.concatenate([self.incidence.indices[self.incidence.indptr[r]:self.incidence.indptr[r + 1]]
+                              for r in rows.tolist()])
+    np.add.at(self.remaining, columns, -1 if assigned else 1)
+
+
+def pack_cluster(rows, matrix, column):
+  """Grabs more rows that seem relevant until there are 7. Returns the pivot columns."""
+  ranked, _ = matrix.ranked(rows)
+  pivots = set([column])
+  while len(rows) < 7:
+    # Counts are taken once up front, so the first open hashtag in this
+    # ranking is the one to pull the next row from
+    open_columns = ranked[matrix.remaining[ranked] > 0]
+    if not len(open_columns):
+      break
+    pivots.add(int(open_columns[0]))
+    row = matrix.first_unassigned(open_columns[0])
+    rows.append(int(row))
+    matrix.assign([row])
+
+  # Also add hashtags that most rows have, but were not originally used to
+  # pivot. Groups of 3 or fewer are dropped by the caller, so skip them.
+  if len(rows) > 3:
+    columns, counts = matrix.ranked(rows)
+    pivots.update(columns[counts > len(rows) / 2].tolist())
+  return pivots
+
+
+def group_threads(threads):
+  """Groups hashtagged threads into clusters of 4-7 around shared pivot hashtags."""
+  threads = list(threads)
+  matrix = HashtagMatrix([thread.hashtag_ids for thread in threads])
 
   clusters = []
-  threads = set(threads)
-  for hashtag, _ in hashtag_counter.most_common():
-    relevant_threads = set([thread for thread in threads if hashtag in thread.hashtags])
-    if len(relevant_threads) < 8:
-      threads = threads - relevant_threads
-      # Note: this mutates threads and relevant_threads
-      pivot_hashtags = pack_cluster(relevant_threads, threads, hashtag)
-      if len(relevant_threads) > 3:
-        clusters.append(TweetCluster(relevant_threads, hashtags=pivot_hashtags))
-      else:
-        threads.update(relevant_threads)
-
-  misc = []
-  for thread in threads:
-    found = False
-    for c in clusters:
-      for t in c.threads:
-        found = found or thread.conversation_id == t.conversation_id
-    if not found:
-      misc.append(thread)
+  for column in matrix.most_common().tolist():
+    # Skip hashtags already fully clustered, or shared by too many threads
+    if not 0 < matrix.remaining[column] < 8:
+      continue
+    rows = matrix.unassigned_rows(column).tolist()
+    matrix.assign(rows)
+    # Note: this mutates matrix and rows
+    pivots = pack_cluster(rows, matrix, column)
+    if len(rows) > 3:
+      clusters.append(TweetCluster(set(threads[r] for r in rows), hashtags=set(matrix.words(sorted(pivots)))))
+    else:
+      matrix.assign(rows, assigned=False)
+
+  clustered_conversations = set(t.conversation_id for c in clusters for t in c.threads)
+  misc = [threads[r] for r in np.flatnonzero(~matrix.assigned).tolist()
+          if threads[r].conversation_id not in clustered_conversations]
   clusters.append(TweetCluster(misc, hashtags=[], summary="misc"))
 
   return clusters
 
 
+async def cluster_threads(threads, batched=False, engine="llm", executor=None):
+  if engine == "embedding":
+    # Imported here because embedding_clustering builds on this module's classes
+    from embedding_clustering import embed_and_cluster
+    if executor is not None:
+      return await asyncio.get_running_loop().run_in_executor(executor, embed_and_cluster, threads)
+    return embed_and_cluster(threads)
+
+  if batched:
+    hashtagged = await add_hashtags_batched(threads)
+  else:
+    hashtagged = await asyncio.gather(*[add_hashtags(thread) for thread in threads])
+  # Threads we couldn't hashtag still go in misc
+  threads = [h or HashtagsThread(thread, []) for thread, h in zip(threads, hashtagged)]
+  # with open('hashtag_threads.pkl', 'wb') as file_:
+  #   pickle.dump(threads, file_)
+  # with open('hashtag_threads.pkl', 'rb') as file_:
+  #   threads = pickle.load(file_)
+
+  return group_threads(threads)
+
+
 def meta_cluster(clusters):
-  hashtag_counter = count_hashtags(clusters)
+  clusters = list(clusters)
+  matrix = HashtagMatrix([VOCABULARY.encode(c.hashtags) for c in clusters])
   meta_clusters = []
-  clusters = set(clusters)
-  for hashtag, _ in hashtag_counter.most_common():
-    relevant_clusters = set([c for c in clusters if hashtag in c.hashtags])
-    clusters -= relevant_clusters
-    if len(relevant_clusters) == 1:
-      meta_clusters.append(list(relevant_clusters)[0])
-    elif len(relevant_clusters) > 1:
-      meta_cluster_hashtags = count_hashtags(relevant_clusters)
-      meta_cluster_pivot_hashtags = [h for h, count in meta_cluster_hashtags.most_common()
-                            if count > len(relevant_clusters) / 2]
-      meta_clusters.append(TweetCluster([], hashtags=meta_cluster_pivot_hashtags, subclusters=relevant_clusters))
+  for column in matrix.most_common().tolist():
+    rows = matrix.unassigned_rows(column)
+    if not len(rows):
+      continue
+    matrix.assign(rows)
+    if len(rows) == 1:
+      meta_clusters.append(clusters[rows[0]])
+    else:
+      columns, counts = matrix.ranked(rows.tolist())
+      meta_cluster_pivot_hashtags = matrix.words(columns[counts > len(rows) / 2])
+      meta_clusters.append(TweetCluster([], hashtags=meta_cluster_pivot_hashtags,
+                                        subclusters=set(clusters[r] for r in rows.tolist())))
 
   return meta_clusters
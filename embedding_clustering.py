@@ -0,0 +1,101 @@
+import re
+from collections import Counter
+import numpy as np
+from clustering import HashtagsThread, TweetCluster
+
+# Same cluster sizes pack_cluster aims for
+MIN_CLUSTER_SIZE = 4
+MAX_CLUSTER_SIZE = 7
+SIMILARITY_THRESHOLD = 0.2
+NUM_HASHTAGS = 30
+NUM_CLUSTER_HASHTAGS = 5
+
+STOPWORDS = set("""
+a about after again all also am an and any are as at be because been before being between both but by
+can could did do does doing down during each few for from further had has have having he her here hers
+him his how i if in into is it its itself just like me more most my no nor not now of off on once only
+or other our ours out over own rt same she should so some such than that the their theirs them then there
+these they this those through to too under until up very was we were what when where which while who
+whom why will with would you your yours retweet https http amp
+""".split())
+
+
+def tokenize(text):
+  text = re.sub(r'https?://\S+', ' ', text.lower())
+  return [w for w in re.findall(r"[#@]?[a-z0-9_']{3,}", text) if w.lstrip('#@') not in STOPWORDS]
+
+
+def tfidf_matrix(threads):
+  """Rows are L2-normalised TF-IDF vectors over terms shared by at least two threads."""
+  counts = [Counter(tokenize(thread.text)) for thread in threads]
+  doc_freq = Counter(term for c in counts for term in c)
+  vocab = {term: i for i, term in enumerate(t for t, df in doc_freq.items() if df > 1)}
+  terms = np.array(list(vocab), dtype=object)
+
+  matrix = np.zeros((len(threads), len(vocab)), dtype=np.float32)
+  for row, c in enumerate(counts):
+    for term, count in c.items():
+      if term in vocab:
+        matrix[row, vocab[term]] = count
+  if not vocab:
+    return matrix, terms
+
+  idf = np.log(len(threads) / np.array([doc_freq[t] for t in terms], dtype=np.float32)) + 1
+  matrix = np.log1p(matrix) * idf
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  return matrix / np.maximum(norms, 1e-9), terms
+
+
+def top_terms(weights, terms, n):
+  order = np.argsort(-weights)[:n]
+  return ['#' + terms[i].lstrip('#@') for i in order if weights[i] > 0]
+
+
+def group_by_similarity(similarity):
+  """Greedy agglomeration: the densest unassigned thread pulls in its nearest neighbours.
+
+  Returns lists of row indices, each between MIN_CLUSTER_SIZE and
+  MAX_CLUSTER_SIZE long, plus the leftover rows.
+  """
+  n = similarity.shape[0]
+  unassigned = np.ones(n, dtype=bool)
+  neighbours = similarity >= SIMILARITY_THRESHOLD
+  np.fill_diagonal(neighbours, False)
+  # Number of unassigned similar neighbours per thread, updated as groups form
+  degree = neighbours.sum(axis=1)
+  groups = []
+  while True:
+    candidates = np.where(unassigned, degree, -1)
+    pivot = np.argmax(candidates)
+    # Stop once no thread has enough similar neighbours left for a cluster
+    if candidates[pivot] < MIN_CLUSTER_SIZE - 1:
+      break
+    scores = np.where(unassigned & neighbours[pivot], similarity[pivot], -1)
+    members = [pivot, *np.argsort(-scores)[:MAX_CLUSTER_SIZE - 1]]
+    members = [m for m in members if m == pivot or scores[m] >= SIMILARITY_THRESHOLD]
+    unassigned[members] = False
+    degree -= neighbours[:, members].sum(axis=1)
+    groups.append(members)
+  return groups, np.flatnonzero(unassigned)
+
+
+def embed_and_cluster(threads):
+  """Clusters threads by TF-IDF cosine similarity without calling the LLM.
+
+  Produces the same TweetCluster structure as cluster_threads, with hashtags
+  derived from each thread's and cluster's highest weighted terms.
+  """
+  threads = list(threads)
+  if not threads:
+    return [TweetCluster([], hashtags=[], summary="misc")]
+  matrix, terms = tfidf_matrix(threads)
+  hashtag_threads = [HashtagsThread(thread, top_terms(matrix[i], terms, NUM_HASHTAGS))
+                     for i, thread in enumerate(threads)]
+
+  groups, leftover = group_by_similarity(matrix @ matrix.T)
+  clusters = []
+  for members in groups:
+    hashtags = set(top_terms(matrix[members].sum(axis=0), terms, NUM_CLUSTER_HASHTAGS))
+    clusters.append(TweetCluster(set(hashtag_threads[i] for i in members), hashtags=hashtags))
+  clusters.append(TweetCluster([hashtag_threads[i] for i in leftover], hashtags=[], summary="misc"))
+  return clusters
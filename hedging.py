@@ -0,0 +1,144 @@
+import asyncio
+import threading
+from collections import deque
+from os import environ
+from metrics import record_hedge
+
+# Latencies kept per (model, stage) for the hedge deadline, and how many are
+# needed before hedging starts
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+# Hedges a model may save up while traffic is quiet
+MAX_HEDGE_CREDIT = 5
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Hedger:
+  """Fires a duplicate of a slow request and takes whichever answers first.
+
+  A request is slow once it's been out longer than the given percentile of
+  recent latencies for its model and stage. Each request earns max_extra of
+  a hedge for its model, so hedges add at most about max_extra to the number
+  of requests, and the spend, per model.
+
+  Like the scheduler, this is shared by every event loop in the process, so
+  state is guarded by a threading.Lock.
+  """
+  def __init__(self, enabled=False, percentile=95, max_extra=0.05, min_delay=1.0):
+    self.enabled = enabled
+    self.percentile = percentile
+    self.max_extra = max_extra
+    self.min_delay = min_delay
+    self.latencies = {}
+    self.credit = {}
+    self.counts = {}
+    self.lock = threading.Lock()
+
+  def delay(self, model, stage):
+    """Seconds before a request is hedged, or None while there's too little to go on."""
+    with self.lock:
+      latencies = self.latencies.get((model, stage))
+      if latencies is None or len(latencies) < MIN_SAMPLES:
+        return None
+      return max(self.min_delay, percentile(latencies, self.percentile))
+
+  def observe(self, model, stage, seconds):
+    with self.lock:
+      self.latencies.setdefault((model, stage), deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+  def count(self, model, stage, outcome):
+    with self.lock:
+      counts = self.counts.setdefault((model, stage), {})
+      counts[outcome] = counts.get(outcome, 0) + 1
+    record_hedge(model, stage, outcome)
+
+  def earn(self, model):
+    with self.lock:
+      self.credit[model] = min(MAX_HEDGE_CREDIT, self.credit.get(model, 0) + self.max_extra)
+
+  def spend(self, model):
+    with self.lock:
+      if self.credit.get(model, 0) < 1:
+        return False
+      self.credit[model] -= 1
+      return True
+
+  async def run(self, call, model, stage, can_send=lambda: True, release=None):
+    """Awaits call(hedge=False), and a call(hedge=True) duplicate if it's slow.
+
+    can_send() is asked before a duplicate goes out, e.g. to take a
+    concurrency slot and rate limit room, and release() is called once the
+    duplicate is done, however it ends. The loser is cancelled. If both fail,
+    the primary's error is raised.
+    """
+    if not self.enabled:
+      return await call(hedge=False)
+    # Routed stages look like summary/gpt-4
+    stage = stage.split('/')[0]
+    self.earn(model)
+    self.count(model, stage, "requests")
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    delay = self.delay(model, stage)
+    primary = asyncio.ensure_future(call(hedge=False))
+    tasks = [primary]
+    try:
+      done, _ = await asyncio.wait(tasks, timeout=delay)
+      if not done:
+        if not self.spend(model):
+          self.count(model, stage, "over_budget")
+        elif not can_send():
+          self.count(model, stage, "throttled")
+        else:
+          self.count(model, stage, "hedged")
+          hedge = asyncio.ensure_future(call(hedge=True))
+          if release is not None:
+            # A callback, so it runs even if the task is cancelled before it starts
+            hedge.add_done_callback(lambda _: release())
+          tasks.append(hedge)
+
+      pending = set(tasks)
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if not task.cancelled() and task.exception() is None:
+            if len(tasks) > 1:
+              self.count(model, stage, "primary_won" if task is primary else "hedge_won")
+            self.observe(model, stage, loop.time() - started)
+            return task.result()
+      return primary.result()
+    finally:
+      for task in tasks:
+        task.cancel()
+
+  def stats(self):
+    """Per model and stage: the current hedge delay and what requests did."""
+    with self.lock:
+      keys = sorted(set(self.counts) | set(self.latencies))
+      counts = {key: dict(self.counts.get(key, {})) for key in keys}
+      credit = dict(self.credit)
+    return [{
+      "model": model,
+      "stage": stage,
+      "delay": self.delay(model, stage),
+      "credit": round(credit.get(model, 0), 2),
+      **counts[(model, stage)],
+    } for model, stage in keys]
+
+
+_hedger = None
+
+def get_hedger():
+  global _hedger
+  if _hedger is None:
+    _hedger = Hedger(
+      enabled=environ.get('LLM_HEDGING', '0') == '1',
+      percentile=float(environ.get('LLM_HEDGE_PERCENTILE', 95)),
+      max_extra=float(environ.get('LLM_HEDGE_MAX_EXTRA', 0.05)),
+      min_delay=float(environ.get('LLM_HEDGE_MIN_DELAY', 1.0)),
+    )
+  return _hedger
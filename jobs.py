@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+
+class JobRunner:
+    """Runs pipeline jobs as asyncio tasks on a dedicated background event loop.
+
+    Under uvicorn, async views run on the server's event loop (under the
+    Flask dev server, on a short-lived loop per request). Either way,
+    long-running work scheduled there would compete with request handling,
+    or die with the request, so jobs run here instead. Each uvicorn worker
+    process gets its own runner.
+    """
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.loop = None
+        self.semaphore = None
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def _start(self):
+        ready = threading.Event()
+
+        def run_loop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.semaphore = asyncio.Semaphore(self.max_jobs)
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run_loop, name='job-runner', daemon=True).start()
+        ready.wait()
+
+    async def _run(self, key, coro_factory):
+        try:
+            async with self.semaphore:
+                await coro_factory()
+        finally:
+            with self.lock:
+                self.running.pop(key, None)
+
+    def submit(self, key, coro_factory):
+        """Schedules coro_factory() unless a job with the same key is already in flight.
+
+        Returns False if the job was deduplicated.
+        """
+        with self.lock:
+            # Started lazily so the thread is created after uvicorn forks its workers
+            if self.loop is None:
+                self._start()
+            if key in self.running:
+                return False
+            self.running[key] = asyncio.run_coroutine_threadsafe(self._run(key, coro_factory), self.loop)
+            return True
+
+    def is_running(self, key):
+        with self.lock:
+            return key in self.running
@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import Counter
+import openai
+from llm_cache import get_cache
+from metrics import record_call
+from scheduler import get_scheduler
+from hedging import get_hedger
+
+try:
+  import tiktoken
+except ImportError:
+  tiktoken = None
+
+# Rough budget for the completion when reserving tokens/minute up front
+EXPECTED_COMPLETION_TOKENS = 256
+# Chat formatting adds a few tokens around every message
+TOKENS_PER_MESSAGE = 4
+
+_encodings = {}
+
+def encoding(model):
+  if tiktoken is None:
+    return None
+  if model not in _encodings:
+    try:
+      _encodings[model] = tiktoken.encoding_for_model(model)
+    except KeyError:
+      _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+      # tiktoken downloads its vocabularies on first use
+      print(f"Couldn't load the {model} tokenizer, estimating token counts instead. Error: {str(e)}")
+      _encodings[model] = None
+  return _encodings[model]
+
+
+def estimate_text_tokens(text, model="gpt-4"):
+  enc = encoding(model)
+  if enc is None:
+    # ~4 characters per token for English text
+    return len(text) // 4
+  return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_text(text, max_tokens, model="gpt-4"):
+  """Cuts text down to at most max_tokens, marking where it was cut."""
+  if estimate_text_tokens(text, model) <= max_tokens:
+    return text
+  # Leave room for the "..."
+  max_tokens = max(max_tokens - 1, 0)
+  enc = encoding(model)
+  if enc is None:
+    return text[:max_tokens * 4] + "..."
+  return enc.decode(enc.encode(text, disallowed_special=())[:max_tokens]) + "..."
+
+
+def estimate_tokens(messages, model="gpt-4"):
+  return sum(estimate_text_tokens(m["content"], model) + TOKENS_PER_MESSAGE for m in messages) + EXPECTED_COMPLETION_TOKENS
+
+
+class TokenUsage:
+  """Prompt and completion tokens spent per pipeline stage."""
+  def __init__(self):
+    self.stages = {}
+    self.lock = threading.Lock()
+
+  def record(self, stage, prompt_tokens=0, completion_tokens=0, cached=False):
+    with self.lock:
+      counts = self.stages.setdefault(stage, Counter())
+      counts["cached" if cached else "requests"] += 1
+      counts["prompt_tokens"] += prompt_tokens
+      counts["completion_tokens"] += completion_tokens
+
+  def summary(self):
+    with self.lock:
+      return {stage: dict(counts) for stage, counts in self.stages.items()}
+
+
+# Usage across every run in this process, and for the run in progress
+total_usage = TokenUsage()
+current_usage = contextvars.ContextVar('current_usage', default=None)
+
+def track_usage():
+  """Starts counting tokens for the current task and the tasks it spawns."""
+  usage = TokenUsage()
+  current_usage.set(usage)
+  return usage
+
+
+def record_usage(stage, **counts):
+  total_usage.record(stage, **counts)
+  usage = current_usage.get()
+  if usage is not None:
+    usage.record(stage, **counts)
+
+
+async def chat_completion(model, messages, err_return, deadline=None, stage=None, check_cache=True):
+  """Returns the stripped completion text, served from the response cache when possible.
+
+  Requests go through the shared scheduler, which retries failures and returns
+  err_return if the request never succeeds, and are hedged if LLM_HEDGING is
+  on. Token usage is recorded under stage, or the model name if not given.
+  check_cache=False skips the cache lookup, for callers that just made it.
+  The cache is read and written from a thread, off the event loop.
+  """
+  stage = stage or model
+  cache = get_cache()
+  response_text = await asyncio.to_thread(cache.get, model, messages, stage) if check_cache else None
+  if response_text is not None:
+    record_usage(stage, cached=True)
+    record_call(model, stage, 0, outcome='cached')
+    return response_text
+
+  async def send(hedge):
+    started = time.perf_counter()
+    try:
+      response = await openai.ChatCompletion.acreate(
+        model=model,
+        messages=messages
+      )
+    except asyncio.CancelledError:
+      # The scheduler timed the attempt out, or the other half of a hedge won
+      record_call(model, stage, time.perf_counter() - started, outcome='cancelled', hedge=hedge)
+      raise
+    except BaseException:
+      record_call(model, stage, time.perf_counter() - started, outcome='failed', hedge=hedge)
+      raise
+    usage = response.get('usage') or {}
+    counts = dict(prompt_tokens=usage.get('prompt_tokens', 0), completion_tokens=usage.get('completion_tokens', 0))
+    record_usage(stage, **counts)
+    record_call(model, stage, time.perf_counter() - started, hedge=hedge, **counts)
+    return response.choices[0].message['content'].strip()
+
+  scheduler = get_scheduler()
+  num_tokens = estimate_tokens(messages, model)
+
+  def can_hedge():
+    # The duplicate skips the scheduler's queue, but not its concurrency cap or the rate limits
+    return scheduler.try_start_extra(model, num_tokens)
+
+  async def request():
+    return await get_hedger().run(send, model, stage, can_hedge, scheduler.finish_extra)
+
+  response_text = await scheduler.submit(request, model, num_tokens, None, deadline=deadline)
+  if response_text is None:
+    return err_return
+  await asyncio.to_thread(cache.set, model, messages, response_text)
+  return response_text
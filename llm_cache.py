@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from os import environ
+from metrics import record_cache_lookup
+
+# How often (in inserts) the sqlite backend sweeps expired and
+# least-recently-used entries. Counting rows on every insert is a full scan.
+EVICTION_INTERVAL = 100
+
+
+def cache_key(model, messages):
+  payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SQLiteBackend:
+  def __init__(self, path, ttl, max_entries):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.inserts = 0
+    # uvicorn workers share the file, so let sqlite do the cross-process locking
+    self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('PRAGMA synchronous=NORMAL')
+    self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+      )""")
+    self.conn.execute('CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)')
+
+  def get(self, key):
+    now = time.time()
+    with self.lock:
+      row = self.conn.execute('SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        return None
+      value, created_at = row
+      if now - created_at > self.ttl:
+        self.conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+        return None
+      self.conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+      return value
+
+  def set(self, key, value):
+    now = time.time()
+    with self.lock:
+      self.conn.execute('INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)', (key, value, now, now))
+      self.inserts += 1
+      if self.inserts % EVICTION_INTERVAL == 0:
+        self._evict(now)
+
+  def _evict(self, now):
+    self.conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+    self.conn.execute("""
+      DELETE FROM llm_cache WHERE key IN (
+        SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+      )""", (self.max_entries,))
+
+
+class RedisBackend:
+  """Size bounds are left to the server, e.g. maxmemory-policy allkeys-lru."""
+  def __init__(self, url, ttl):
+    import redis
+    self.client = redis.Redis.from_url(url)
+    self.ttl = ttl
+
+  def get(self, key):
+    value = self.client.get(f'llm:{key}')
+    if value is None:
+      return None
+    # Refresh the TTL on read so hot prompts stay cached
+    self.client.expire(f'llm:{key}', self.ttl)
+    return value.decode('utf-8')
+
+  def set(self, key, value):
+    self.client.set(f'llm:{key}', value, ex=self.ttl)
+
+
+class LLMCache:
+  def __init__(self, backend):
+    self.backend = backend
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, model, messages, stage=None):
+    """The cached answer, or None. Each call counts as one lookup, so callers
+    shouldn't look the same prompt up twice."""
+    if self.backend is None:
+      return None
+    value = self.backend.get(cache_key(model, messages))
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    record_cache_lookup(model, stage or model, value is not None)
+    return value
+
+  def set(self, model, messages, value):
+    if self.backend is not None:
+      self.backend.set(cache_key(model, messages), value)
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / total if total else 0.0,
+    }
+
+
+_cache = None
+
+def get_cache():
+  global _cache
+  if _cache is None:
+    backend_name = environ.get('LLM_CACHE_BACKEND', 'sqlite')
+    ttl = int(environ.get('LLM_CACHE_TTL', 7 * 24 * 60 * 60))
+    if backend_name == 'redis':
+      backend = RedisBackend(environ.get('LLM_CACHE_REDIS_URL', 'redis://localhost:6379/0'), ttl)
+    elif backend_name == 'sqlite':
+      backend = SQLiteBackend(environ.get('LLM_CACHE_PATH', '/tmp/llm_cache.db'), ttl,
+                              int(environ.get('LLM_CACHE_MAX_ENTRIES', 100000)))
+    else:
+      backend = None
+    _cache = LLMCache(backend)
+  return _cache
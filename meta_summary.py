@@ -1,7 +1,12 @@
-import openai
+from os import environ
 from twitter import Thread
 import asyncio
-from clustering import with_retries, TweetCluster
+import json
+from clustering import stable_order, TweetCluster
+from prompt_budget import fit_texts
+from summary import summary_token_budget, parse_topic
+from routing import routed_completion, prompt_variants
+from metrics import record_fallback
 import re
 import time
 from collections import Counter
@@ -36,80 +41,156 @@ What topic do all TWEETS have in common? Rules:
 
 Do not think. Just say the topic and only the topic."""
 
+JOINT_SUBCLUSTER = """\
+SUBCLUSTER {label} ({num_tweets} tweets, related to {hashtags})
+SUMMARY: {summary}
+TWEETS:
+\"\"\"
+{tweets_text}
+\"\"\""""
+
+JOINT_META_SUMMARY_PROMPT = """\
+{subclusters}
+
+What common theme unites all {num_tweets} tweets in these subclusters, and what is each subcluster more specifically about? Rules:
+
+- The theme must begin with "{num_tweets} tweets are about"
+- The theme must be no more than 1 sentence.
+- The theme must be discussed in a majority of the tweets.
+- Each subcluster's topic must begin with its number of tweets followed by "are about", e.g. "12 are about"
+- Each subcluster's topic must be no more than 1 sentence, more specific than the theme, and discussed in a majority of its tweets.
+
+Do not think. Answer with JSON only, in this form:
+{{"theme": "{num_tweets} tweets are about ...", "subclusters": {{{example}}}}}"""
+
+
+def parse_resummary(response_text):
+  """Returns what the subcluster is more specifically about, or None."""
+  summary = response_text.strip('"')
+  if 'specifically,' not in summary:
+    return None
+  _, summary = summary.split('specifically,', 1)
+  if 'about' not in summary:
+    return None
+  _, summary = summary.split('about', 1)
+  return summary
+
+
+def joint_enabled():
+  return environ.get('JOINT_META_SUMMARY', '1') == '1'
+
+
+def parse_about(text):
+  if not isinstance(text, str) or 'about' not in text:
+    return None
+  _, text = text.split('about', 1)
+  return text
+
+
+def parse_joint_summary(response_text, labels):
+  """Returns (theme, {label: specific topic}), or None if there's no theme.
+
+  Subclusters missing from the answer, or whose topic doesn't parse, are
+  left out of the dict.
+  """
+  start, end = response_text.find('{'), response_text.rfind('}')
+  try:
+    answer = json.loads(response_text[start:end + 1])
+  except ValueError:
+    return None
+  if not isinstance(answer, dict):
+    return None
+  theme = parse_about(answer.get('theme'))
+  if theme is None:
+    return None
+  topics = answer.get('subclusters')
+  topics = topics if isinstance(topics, dict) else {}
+  parsed = {label: parse_about(topics.get(label)) for label in labels}
+  return theme, {label: topic for label, topic in parsed.items() if topic is not None}
+
+
+async def resummarize_subcluster(cluster, subcluster):
+  texts = fit_texts([thread.text for thread in stable_order(subcluster.threads)], summary_token_budget())
+  tweets_text = "\n\n".join(texts)
+  prompt = RESUMMARY_PROMPT.format(
+    tweets_text=tweets_text,
+    num_tweets=subcluster.num_tweets,
+    num_cluster_tweets=cluster.num_tweets,
+    cluster_summary=cluster.summary,
+    hashtags=" ".join(sorted(subcluster.hashtags))
+  )
+  summary = await routed_completion("resummary", prompt_variants(prompt), parse_resummary)
+  return TweetCluster(subcluster.threads, hashtags=subcluster.hashtags, summary=summary, subclusters=subcluster.subclusters)
+
 
 async def resummarize(cluster):
   """Given a meta-cluster, resummarize the subclusters to be more specific."""
-  async def resummarize_subcluster(subcluster):
-    tweets_text = "\n\n".join([thread.text for thread in subcluster.threads])
-    messages = [
-      {"role": "system", "content": "You are a helpful assistant."},
-      {"role": "user", "content": RESUMMARY_PROMPT.format(
-        tweets_text=tweets_text,
-        num_tweets=subcluster.num_tweets,
-        num_cluster_tweets=cluster.num_tweets,
-        cluster_summary=cluster.summary,
-        hashtags=" ".join(subcluster.hashtags)
-      )}
-    ]
-
-    async def get_summary():
-      print("sending request...")
-      response = await openai.ChatCompletion.acreate(
-        model="gpt-4",
-        # model="gpt-3.5-turbo",
-        messages=messages
-      )
-      return response.choices[0].message['content'].strip()
-
-    response_text = await with_retries(get_summary, "API error")
-    try:
-      summary = response_text.strip('"')
-      _, summary = summary.split('specifically,', 1)
-      _, summary = summary.split('about', 1)
-    except:
-      summary = f'Error parsing model output: {response_text}'
-    return TweetCluster(subcluster.threads, hashtags=subcluster.hashtags, summary=summary, subclusters=subcluster.subclusters) 
-
-  subclusters = await asyncio.gather(*[resummarize_subcluster(c) for c in cluster.subclusters])
+  subclusters = await asyncio.gather(*[resummarize_subcluster(cluster, c) for c in cluster.subclusters])
   return TweetCluster(cluster.threads, hashtags=cluster.hashtags, summary=cluster.summary, subclusters=subclusters)
 
 
-
-async def generate_meta_summary(cluster):
-  if cluster.summary:
-    return cluster
-
-  summaries = "\n\n".join([c.summary for c in cluster.subclusters])
-  messages = [
-    {"role": "system", "content": "You are a helpful assistant."},
-    {"role": "user", "content": META_SUMMARY_PROMPT.format(
-      summaries=summaries,
-      num_tweets=cluster.num_tweets,
-    )}
+async def joint_meta_summary(cluster):
+  """Summarizes a meta-cluster and resummarizes its subclusters in one request.
+
+  The tweets of all subclusters share one summary token budget. Returns None
+  if the theme can't be parsed; subclusters whose topics can't be are
+  resummarized one request each, as before.
+  """
+  subclusters = sorted(cluster.subclusters, key=lambda c: (c.summary or "", sorted(c.hashtags or [])))
+  labels = [str(i + 1) for i in range(len(subclusters))]
+  budget = summary_token_budget() // max(1, len(subclusters))
+  blocks = []
+  for label, subcluster in zip(labels, subclusters):
+    texts = fit_texts([thread.text for thread in stable_order(subcluster.threads)], budget)
+    blocks.append(JOINT_SUBCLUSTER.format(
+      label=label,
+      num_tweets=subcluster.num_tweets,
+      hashtags=" ".join(sorted(subcluster.hashtags)),
+      summary=(subcluster.summary or "").strip(),
+      tweets_text="\n\n".join(texts),
+    ))
+  prompt = JOINT_META_SUMMARY_PROMPT.format(
+    subclusters="\n\n".join(blocks),
+    num_tweets=cluster.num_tweets,
+    example=", ".join(f'"{label}": "{subcluster.num_tweets} are about ..."'
+                      for label, subcluster in zip(labels, subclusters)),
+  )
+  parsed = await routed_completion("joint_meta_summary", prompt_variants(prompt),
+                                   lambda text: parse_joint_summary(text, labels))
+  if not isinstance(parsed, tuple):
+    record_fallback("joint_meta_summary", "theme")
+    return None
+
+  summary, topics = parsed
+  out = TweetCluster(cluster.threads, hashtags=cluster.hashtags, summary=summary, subclusters=cluster.subclusters)
+  missing = [subcluster for label, subcluster in zip(labels, subclusters) if label not in topics]
+  if missing:
+    print(f"Couldn't parse {len(missing)} of {len(subclusters)} subcluster topics, resummarizing them separately")
+    record_fallback("joint_meta_summary", "subcluster", len(missing))
+  resummarized = iter(await asyncio.gather(*[resummarize_subcluster(out, c) for c in missing]))
+  out.subclusters = [
+    TweetCluster(subcluster.threads, hashtags=subcluster.hashtags, summary=topics[label],
+                 subclusters=subcluster.subclusters) if label in topics else next(resummarized)
+    for label, subcluster in zip(labels, subclusters)
   ]
+  return out
 
-  async def get_summary():
-    print("sending request...")
-    response = await openai.ChatCompletion.acreate(
-      model="gpt-4",
-      # model="gpt-3.5-turbo",
-      messages=messages
-    )
-    return response.choices[0].message['content'].strip()
 
-  response_text = await with_retries(get_summary, "API error")
 
-  try:
-    lines = response_text.split("\n")
-    summary = None
-    for line in lines:
-      if "TOPIC" in line:
-        summary = line[len("TOPIC")+1:]
-
-    summary = summary.strip('"')
-    _, summary = summary.split('about', 1)
-  except:
-    summary = f"Error parsing model output: {response_text}"
+async def generate_meta_summary(cluster):
+  if cluster.summary:
+    return cluster
+  if joint_enabled() and cluster.subclusters:
+    joint = await joint_meta_summary(cluster)
+    if joint is not None:
+      return joint
+
+  summaries = "\n\n".join(sorted([c.summary for c in cluster.subclusters]))
+  prompt = META_SUMMARY_PROMPT.format(
+    summaries=summaries,
+    num_tweets=cluster.num_tweets,
+  )
+  summary = await routed_completion("meta_summary", prompt_variants(prompt), parse_topic)
 
   out = TweetCluster(cluster.threads, hashtags=cluster.hashtags, summary=summary, subclusters=cluster.subclusters)
   return await resummarize(out)
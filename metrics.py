@@ -0,0 +1,305 @@
+import contextvars
+import threading
+import time
+import uuid
+from collections import Counter as Counts, deque
+
+# Seconds. LLM calls range from well under a second (cached, small hashtag
+# batches) to a minute or more (gpt-4 reasoning under load)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40, 80)
+STAGE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320, 640)
+
+# Dollars per 1K (prompt, completion) tokens, matched by model name prefix
+PRICES = {
+  "gpt-4": (0.03, 0.06),
+  "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+# Finished and in-progress runs kept for /admin/traces
+TRACE_HISTORY = 100
+# Calls recorded per trace; past this they're only counted
+MAX_TRACE_CALLS = 2000
+
+
+def cost(model, prompt_tokens, completion_tokens):
+  prefixes = [p for p in PRICES if model.startswith(p)]
+  if not prefixes:
+    return 0.0
+  prompt_price, completion_price = PRICES[max(prefixes, key=len)]
+  return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Metric:
+  kind = None
+
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.values = {}
+    self.lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+    with self.lock:
+      for labels, value in sorted(self.values.items()):
+        lines.extend(self.samples(labels, value))
+    return lines
+
+  def samples(self, labels, value):
+    return [f'{self.name}{label_text(labels)} {value}']
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    with self.lock:
+      self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets):
+    super().__init__(name, help)
+    self.buckets = buckets
+
+  def observe(self, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+      counts[-2] += 1
+      counts[-1] += value
+
+  def samples(self, labels, counts):
+    lines = [f'{self.name}_bucket{label_text(labels + (("le", bound),))} {count}'
+             for bound, count in zip(self.buckets, counts)]
+    lines.append(f'{self.name}_bucket{label_text(labels + (("le", "+Inf"),))} {counts[-2]}')
+    lines.append(f'{self.name}_sum{label_text(labels)} {counts[-1]}')
+    lines.append(f'{self.name}_count{label_text(labels)} {counts[-2]}')
+    return lines
+
+
+REGISTRY = []
+
+RUNS = Counter('pipeline_runs_total', 'Pipeline runs by engine and outcome.')
+RUN_SECONDS = Histogram('pipeline_run_seconds', 'Wall time of whole pipeline runs.', STAGE_BUCKETS)
+STAGE_SECONDS = Histogram('pipeline_stage_seconds', 'Wall time of each pipeline stage. Stages overlap.', STAGE_BUCKETS)
+ITEMS = Counter('pipeline_items_total', 'Threads, clusters and so on processed by pipeline runs.')
+LLM_SECONDS = Histogram('llm_request_seconds', 'Latency of each OpenAI request attempt.', LATENCY_BUCKETS)
+LLM_REQUESTS = Counter('llm_requests_total', 'LLM calls by outcome: ok, failed or cancelled (an attempt) or cached.')
+LLM_CACHE_LOOKUPS = Counter('llm_cache_lookups_total', 'Response cache lookups by result: hit or miss.')
+LLM_RETRIES = Counter('llm_retries_total', 'Request attempts retried, by reason.')
+LLM_ESCALATIONS = Counter('llm_escalations_total', "Answers that didn't parse and went to the next tier of the route.")
+LLM_HEDGES = Counter('llm_hedges_total', 'Hedging by outcome: requests, hedged, primary_won, hedge_won, over_budget or throttled (no concurrency or rate limit room).')
+SUMMARY_MEMO_LOOKUPS = Counter('summary_memo_lookups_total', 'Cluster summary memo lookups by result: exact, approximate or miss.')
+LLM_FALLBACKS = Counter('llm_fallbacks_total', 'Joint answers that fell back to one request per part, by what was missing.')
+LLM_GIVE_UPS = Counter('llm_give_ups_total', 'Requests abandoned after their last attempt or deadline.')
+LLM_TOKENS = Counter('llm_tokens_total', 'Tokens sent and received, by kind.')
+LLM_COST = Counter('llm_cost_dollars_total', 'Estimated OpenAI spend.')
+
+
+def render():
+  """All metrics in the Prometheus text format."""
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
+
+
+class Trace:
+  """What one pipeline run did and how long each part took, as JSON for /admin/traces."""
+  def __init__(self, **info):
+    self.id = uuid.uuid4().hex[:12]
+    self.info = info
+    self.started_at = time.time()
+    self.start = time.perf_counter()
+    self.stages = {}
+    self.calls = []
+    self.counts = Counts()
+    self.status = 'running'
+    self.seconds = None
+    self.usage = None
+    self.cost = 0.0
+    self.lock = threading.Lock()
+
+  def elapsed(self):
+    return time.perf_counter() - self.start
+
+  def start_stage(self, name):
+    with self.lock:
+      self.stages.setdefault(name, [self.elapsed(), None])
+
+  def end_stage(self, name):
+    with self.lock:
+      span = self.stages.get(name)
+      if span is None or span[1] is not None:
+        return
+      span[1] = self.elapsed()
+    STAGE_SECONDS.observe(span[1] - span[0], stage=name)
+
+  def note(self, **counts):
+    with self.lock:
+      self.counts.update(counts)
+
+  def count(self, **counts):
+    """Adds to the run's counts and to pipeline_items_total."""
+    self.note(**counts)
+    for kind, amount in counts.items():
+      ITEMS.inc(amount, kind=kind)
+
+  def add_call(self, call):
+    with self.lock:
+      if len(self.calls) < MAX_TRACE_CALLS:
+        self.calls.append(call)
+      self.counts['llm_calls'] += 1
+      self.cost += call['cost']
+
+  def finish(self, status, usage=None):
+    if self.seconds is not None:
+      return
+    self.seconds = self.elapsed()
+    self.status = status
+    self.usage = usage
+    for name, span in list(self.stages.items()):
+      if span[1] is None:
+        self.end_stage(name)
+    RUNS.inc(engine=self.info.get('engine', ''), status=status)
+    RUN_SECONDS.observe(self.seconds, engine=self.info.get('engine', ''))
+
+  def stage_seconds(self):
+    with self.lock:
+      return {name: round((end if end is not None else self.elapsed()) - start, 3)
+              for name, (start, end) in self.stages.items()}
+
+  def summary(self):
+    return {
+      'id': self.id,
+      **self.info,
+      'status': self.status,
+      'started_at': self.started_at,
+      'seconds': round(self.seconds if self.seconds is not None else self.elapsed(), 3),
+      'stages': self.stage_seconds(),
+      'counts': dict(self.counts),
+      'cost': round(self.cost, 4),
+    }
+
+  def to_dict(self):
+    with self.lock:
+      stages = {name: {'start': round(start, 3), 'end': None if end is None else round(end, 3)}
+                for name, (start, end) in self.stages.items()}
+      calls = list(self.calls)
+    return {**self.summary(), 'spans': stages, 'usage': self.usage, 'calls': calls}
+
+
+recent_traces = deque(maxlen=TRACE_HISTORY)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def start_trace(**info):
+  """Starts tracing the current task and the tasks it spawns."""
+  trace = Trace(**info)
+  current_trace.set(trace)
+  recent_traces.append(trace)
+  return trace
+
+
+def find_trace(trace_id):
+  for trace in list(recent_traces):
+    if trace.id == trace_id:
+      return trace
+  return None
+
+
+def record_call(model, stage, seconds, prompt_tokens=0, completion_tokens=0, outcome='ok', hedge=False):
+  """Records one LLM call: an OpenAI request (ok, failed or cancelled) or a cache hit.
+
+  hedge marks the duplicate of a slow request.
+  """
+  # Routed stages look like summary/gpt-4, and the model is a label already
+  stage = stage.split('/')[0]
+  dollars = cost(model, prompt_tokens, completion_tokens)
+  LLM_REQUESTS.inc(model=model, stage=stage, outcome=outcome)
+  if outcome != 'cached':
+    LLM_SECONDS.observe(seconds, model=model, stage=stage)
+  if prompt_tokens:
+    LLM_TOKENS.inc(prompt_tokens, model=model, stage=stage, kind='prompt')
+  if completion_tokens:
+    LLM_TOKENS.inc(completion_tokens, model=model, stage=stage, kind='completion')
+  if dollars:
+    LLM_COST.inc(dollars, model=model, stage=stage)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.add_call({
+      'model': model, 'stage': stage, 'outcome': outcome, 'at': round(trace.elapsed() - seconds, 3),
+      'seconds': round(seconds, 3), 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+      'cost': round(dollars, 5), 'hedge': hedge,
+    })
+
+
+def record_cache_lookup(model, stage, hit):
+  LLM_CACHE_LOOKUPS.inc(model=model, stage=stage.split('/')[0], result='hit' if hit else 'miss')
+
+
+def record_retry(model, reason):
+  LLM_RETRIES.inc(model=model, reason=reason)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.note(llm_retries=1)
+
+
+def record_give_up(model, reason):
+  LLM_GIVE_UPS.inc(model=model, reason=reason)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.note(llm_give_ups=1)
+
+
+def record_memo_lookup(result):
+  SUMMARY_MEMO_LOOKUPS.inc(result=result)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.note(**{f'summary_memo_{result}': 1})
+
+
+def record_hedge(model, stage, outcome):
+  LLM_HEDGES.inc(model=model, stage=stage, outcome=outcome)
+  trace = current_trace.get()
+  if trace is not None and outcome in ('hedged', 'hedge_won'):
+    trace.note(**{f'llm_{outcome}': 1})
+
+
+def record_fallback(stage, part, amount=1):
+  LLM_FALLBACKS.inc(amount, stage=stage, part=part)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.note(llm_fallbacks=amount)
+
+
+def record_escalation(stage, model):
+  LLM_ESCALATIONS.inc(stage=stage, model=model)
+  trace = current_trace.get()
+  if trace is not None:
+    trace.note(llm_escalations=1)
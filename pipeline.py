@@ -0,0 +1,247 @@
+import asyncio
+from os import environ
+from twitter import fetch_tweets_async
+from clustering import HashtagsThread, TweetCluster, cluster_threads, iter_hashtags, meta_cluster
+from timeline import MAX_CLUSTER_SIZE, TimelineState, merge_new_threads, update_clusters
+from summary import generate_summary
+from meta_summary import generate_meta_summary
+from llm import track_usage
+from metrics import start_trace
+from result_store import get_store
+
+# Share of the progress bar each stage gets, roughly by how long it takes
+STAGE_WEIGHTS = [
+  ("fetching", 10),
+  ("clustering", 30),
+  ("summarizing", 35),
+  ("meta_summarizing", 25),
+]
+
+# While hashtags come in, dry-run the grouping each time another tenth of
+# the threads is hashtagged
+SPECULATE_EVERY = 0.1
+
+
+class FetchError(Exception):
+  pass
+
+
+def stage_percent(stage, done=0, total=1):
+  percent = 0
+  for name, weight in STAGE_WEIGHTS:
+    if name == stage:
+      percent += weight * done / max(total, 1)
+      break
+    percent += weight
+  return int(percent)
+
+
+def summary_key(cluster):
+  # The same threads, at the same length, with the same hashtags make the same prompt
+  return frozenset((t.conversation_id, t.first_id) for t in cluster.threads), frozenset(cluster.hashtags)
+
+
+class SummaryTasks:
+  """In-flight summary requests by cluster content, so the final clusters can
+  pick up requests started while hashtags were still coming in."""
+  def __init__(self):
+    self.tasks = {}
+
+  def start(self, cluster):
+    key = summary_key(cluster)
+    if key not in self.tasks:
+      self.tasks[key] = asyncio.ensure_future(generate_summary(cluster))
+    return self.tasks[key]
+
+  def cancel(self, keep=()):
+    for task in self.tasks.values():
+      if task not in keep:
+        task.cancel()
+
+
+def speculate(state, hashtagged, summaries, locked, previous_keys, now=None):
+  """Groups the threads hashtagged so far, without touching state.
+
+  Clusters that are already full, or came out the same as in the previous
+  dry run, are taken as settled: they're added to locked, so later groupings
+  leave them alone, and their summaries start now. Returns this run's keys.
+  """
+  keys = set()
+  locked_ids = set(id(cluster) for cluster in locked)
+  # misc is last and never summarized
+  for cluster in update_clusters(state, hashtagged, now=now, dry_run=True, locked=locked)[:-1]:
+    if cluster.summary or id(cluster) in locked_ids:
+      continue
+    key = summary_key(cluster)
+    keys.add(key)
+    if len(cluster.threads) >= MAX_CLUSTER_SIZE or key in previous_keys:
+      locked.append(cluster)
+      summaries.start(cluster)
+  return keys
+
+
+def in_input_order(indexed):
+  return [thread for _, thread in sorted(indexed, key=lambda pair: pair[0])]
+
+
+async def iter_refresh(fetch, engine="llm", batched=True, state=None, trace=None, now=None, executor=None):
+  """Fetches new threads with fetch(since_id), then clusters and summarizes them.
+
+  With the llm engine, state (a TimelineState) makes this an incremental
+  refresh: only tweets newer than the last run are fetched and hashtagged,
+  and only clusters whose membership changed are re-summarized. state is
+  updated in place. Threads are aged out relative to now, the current time
+  unless given.
+
+  Stages overlap: clusters that look settled are locked in and summarized
+  while hashtags are still coming in (unless PIPELINE_OVERLAP=0), and each
+  meta-cluster is summarized as soon as its own subclusters are. The
+  embedding engine's clustering runs in executor, if given.
+
+  Yields (event, payload) pairs as it goes:
+    ("progress", (stage, percent))
+    ("summary", cluster)  - a cluster's summary is ready
+    ("done", (clusters, state)) - the final, meta-summarized clusters and
+                                  the updated state (None unless incremental)
+
+  The run is recorded in trace (see metrics.py), or a new one if not given.
+  """
+  trace = trace or start_trace(engine=engine)
+  usage = track_usage()
+  status = "failed"
+  try:
+    incremental = engine == "llm"
+    if incremental and state is None:
+      state = TimelineState()
+
+    yield "progress", ("fetching", stage_percent("fetching"))
+    trace.start_stage("fetching")
+    try:
+      threads = await fetch(state.since_id if incremental else None)
+    except Exception as e:
+      raise FetchError(e) from e
+    trace.end_stage("fetching")
+    trace.count(fetched_threads=len(threads))
+
+    yield "progress", ("clustering", stage_percent("clustering"))
+    trace.start_stage("clustering")
+    summaries = SummaryTasks()
+    meta_tasks = []
+    try:
+      if incremental:
+        merged = merge_new_threads(state, threads)
+        # Other users' refreshes may have hashtagged the same threads already
+        store = get_store()
+        shared = await asyncio.to_thread(store.shared_hashtags, merged)
+        hashtagged = [(i, thread) for i, thread in enumerate(shared) if thread is not None]
+        unshared = [i for i, thread in enumerate(shared) if thread is None]
+        trace.count(hashtagged_threads=len(merged), shared_threads=len(hashtagged))
+        failed = []
+        locked = []
+        keys = set()
+        next_speculation = SPECULATE_EVERY if environ.get('PIPELINE_OVERLAP', '1') == '1' else 1
+        async for batch in iter_hashtags([merged[i] for i in unshared], batched=batched):
+          # Failed threads stay out of the store and the state's threads, so
+          # nobody takes their empty hashtags for a real answer
+          failed.extend(merged[unshared[j]] for j, thread in batch if thread is None)
+          batch = [(unshared[j], thread) for j, thread in batch if thread is not None]
+          await asyncio.to_thread(store.add_hashtags, [thread for _, thread in batch])
+          hashtagged.extend(batch)
+          yield "progress", ("clustering", stage_percent("clustering", len(hashtagged) + len(failed), len(merged)))
+          if next_speculation <= (len(hashtagged) + len(failed)) / len(merged) < 1:
+            keys = speculate(state, in_input_order(hashtagged), summaries, locked, keys, now)
+            next_speculation += SPECULATE_EVERY
+        # The next refresh hashtags these again
+        state.pending = {t.conversation_id: t for t in failed}
+        clusters = update_clusters(state, in_input_order(hashtagged), now=now, locked=locked)
+        trace.count(failed_hashtags=len(failed))
+        # This run still shows new threads that failed in misc. Extended ones
+        # keep their previous version, which is still in state
+        failed = [HashtagsThread(t, []) for t in failed if t.conversation_id not in state.threads]
+        if failed:
+          misc = clusters[-1]
+          clusters[-1] = TweetCluster([*misc.threads, *failed], hashtags=misc.hashtags, summary=misc.summary)
+      else:
+        clusters = await cluster_threads(threads, batched=batched, engine=engine, executor=executor)
+      trace.end_stage("clustering")
+
+      yield "progress", ("summarizing", stage_percent("summarizing"))
+      trace.start_stage("summarizing")
+      speculative = set(summaries.tasks.values())
+      summary_tasks = [summaries.start(cluster) for cluster in clusters]
+      summaries.cancel(keep=set(summary_tasks))
+      trace.count(clusters=len(clusters), early_summaries=len(speculative & set(summary_tasks)))
+
+      # Meta-clusters only depend on hashtags, so they're known up front
+      task_for = {id(cluster): task for cluster, task in zip(clusters, summary_tasks)}
+      async def meta_summary(cluster):
+        if cluster.subclusters:
+          subclusters = await asyncio.gather(*[task_for[id(c)] for c in cluster.subclusters])
+          cluster = TweetCluster(cluster.threads, hashtags=cluster.hashtags, subclusters=subclusters)
+        else:
+          cluster = await task_for[id(cluster)]
+        return await generate_meta_summary(cluster)
+      meta_tasks = [asyncio.ensure_future(meta_summary(cluster)) for cluster in meta_cluster(clusters)]
+      trace.start_stage("meta_summarizing")
+      trace.count(meta_clusters=len(meta_tasks))
+
+      position = {task: ("summary", i) for i, task in enumerate(summary_tasks)}
+      position.update({task: ("meta_summary", i) for i, task in enumerate(meta_tasks)})
+      summarized = [None] * len(clusters)
+      meta_summarized = [None] * len(meta_tasks)
+      summaries_done = meta_done = 0
+      pending = set(position)
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          kind, i = position[task]
+          if kind == "summary":
+            summarized[i] = task.result()
+            summaries_done += 1
+            # The misc bucket never makes it past meta_cluster, so don't preview it
+            if summarized[i].hashtags:
+              yield "summary", summarized[i]
+          else:
+            meta_summarized[i] = task.result()
+            meta_done += 1
+        if summaries_done < len(clusters):
+          yield "progress", ("summarizing", stage_percent("summarizing", summaries_done, len(clusters)))
+        else:
+          trace.end_stage("summarizing")
+          yield "progress", ("meta_summarizing", stage_percent("meta_summarizing", meta_done, len(meta_tasks)))
+      trace.end_stage("meta_summarizing")
+    finally:
+      # Don't leave requests running if we failed or the caller stopped listening
+      summaries.cancel()
+      for task in meta_tasks:
+        task.cancel()
+
+    if incremental:
+      state.clusters = [c for c in summarized if c.hashtags]
+      state.update_since_id(threads)
+    status = "done"
+    yield "done", (meta_summarized, state if incremental else None)
+  except GeneratorExit:
+    # The caller may stop listening once it has the results
+    if status != "done":
+      status = "cancelled"
+    raise
+  finally:
+    trace.finish(status, usage=usage.summary())
+    print(f'pipeline run {trace.id} {status}: {trace.summary()}')
+
+
+def timeline_fetcher(access_token, access_token_secret):
+  """A fetch for iter_refresh that reads the user's home timeline."""
+  async def fetch(since_id):
+    return await fetch_tweets_async(access_token, access_token_secret, since_id,
+                                    max_results=int(environ.get('TWITTER_MAX_RESULTS', 100)),
+                                    max_pages=int(environ.get('TWITTER_MAX_PAGES', 32)))
+  return fetch
+
+
+def iter_pipeline(access_token, access_token_secret, engine="llm", batched=True, state=None, trace=None):
+  """iter_refresh for the user's home timeline."""
+  return iter_refresh(timeline_fetcher(access_token, access_token_secret),
+                      engine=engine, batched=batched, state=state, trace=trace)
+
@@ -0,0 +1,158 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+from os import environ
+
+DAY = 24 * 60 * 60
+# Visits older than this say little about when the user comes back
+VISIT_HISTORY = 14 * DAY
+# Fewer visits than this and there's no pattern to go on
+MIN_VISITS = 3
+# Visits this close in time of day count as the same habit, and a habit
+# needs at least two of them
+HABIT_WINDOW = 60 * 60
+
+
+def predict_next_visit(visits, now):
+    """Best guess at when the user next opens /tweets, or None.
+
+    People tend to check in at the same times of day, so each time of day
+    they've visited at more than once is expected to come round again.
+    Frequent visitors are also expected back after their usual gap since the
+    last visit. Whichever comes first wins.
+    """
+    if len(visits) < MIN_VISITS:
+        return None
+    visits = sorted(visits)
+    times_of_day = [visit % DAY for visit in visits]
+
+    def habit(time_of_day):
+        return sum(1 for other in times_of_day
+                   if min(abs(other - time_of_day), DAY - abs(other - time_of_day)) <= HABIT_WINDOW) >= 2
+
+    # The next time each habitual visit's time of day comes round
+    candidates = [visit + -(-(now - visit) // DAY) * DAY for visit in visits if habit(visit % DAY)]
+    gaps = sorted(b - a for a, b in zip(visits, visits[1:]))
+    usual_gap = gaps[len(gaps) // 2]
+    # Unless they've already stayed away well past it
+    if usual_gap < DAY and now - visits[-1] < 2 * usual_gap:
+        candidates.append(max(now, visits[-1] + usual_gap))
+    return min(candidates, default=None)
+
+
+def parse_hours(spec):
+    """'2-7' -> (2, 7). The range may wrap past midnight, e.g. '22-5'."""
+    start, end = spec.split('-')
+    return int(start), int(end)
+
+
+class Prewarmer:
+    """Refreshes timelines ahead of users' predicted visits, so that a visit is
+    a cache read instead of a wait.
+
+    Every interval it ranks users expected back within the horizon (the lead
+    at peak times) whose results would be stale by then, soonest visit first,
+    and starts refreshes for as many as the concurrency and daily cost
+    budgets allow. Off-peak it looks further ahead and runs more at once, so
+    LLM traffic moves out of the busy hours. A user refreshed within the
+    horizon before their visit isn't refreshed again: an off-peak refresh
+    hours ahead can't still be fresh at the visit, but the visit gets an
+    incremental refresh instead of a full one.
+
+    candidates(since) yields (user_id, visit times, results saved_at or None),
+    refresh(user_id) starts a refresh and returns whether it did, and
+    is_running(user_id) says whether one is still in flight.
+    """
+    def __init__(self, candidates, refresh, is_running):
+        self.candidates = candidates
+        self.refresh = refresh
+        self.is_running = is_running
+        self.interval = float(environ.get('PREWARM_INTERVAL', 60))
+        # How long before a predicted visit a peak-hours refresh starts
+        self.lead = float(environ.get('PREWARM_LEAD', 30 * 60))
+        self.off_peak_horizon = float(environ.get('PREWARM_OFF_PEAK_HORIZON', 12 * 60 * 60))
+        self.off_peak_hours = parse_hours(environ.get('PREWARM_OFF_PEAK_HOURS', '2-7'))
+        self.max_jobs = int(environ.get('PREWARM_MAX_JOBS', 1))
+        self.off_peak_max_jobs = int(environ.get('PREWARM_OFF_PEAK_MAX_JOBS', 4))
+        self.daily_budget = float(environ.get('PREWARM_DAILY_BUDGET', 5))
+        # Results older than this at visit time get refreshed anyway
+        self.max_age = float(environ.get('REFRESH_INTERVAL', 30 * 60))
+        self.in_flight = set()
+        self.spent = 0.0
+        self.budget_day = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def is_off_peak(self, now):
+        start, end = self.off_peak_hours
+        hour = datetime.fromtimestamp(now).hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def record_cost(self, dollars):
+        with self.lock:
+            self.spent += dollars
+
+    def budget_left(self, now):
+        with self.lock:
+            today = datetime.fromtimestamp(now).date()
+            if today != self.budget_day:
+                self.budget_day = today
+                self.spent = 0.0
+            return self.daily_budget - self.spent
+
+    def due(self, now, horizon):
+        """(predicted visit, user_id) for users worth refreshing now, as a heap."""
+        queue = []
+        for user_id, visits, saved_at in self.candidates(now - VISIT_HISTORY):
+            if user_id in self.in_flight:
+                continue
+            predicted = predict_next_visit(visits, now)
+            if predicted is None or predicted - now > horizon:
+                continue
+            if saved_at is not None and saved_at + self.max_age >= predicted:
+                # Still fresh when they arrive
+                continue
+            if saved_at is not None and saved_at >= predicted - horizon:
+                # Already refreshed for this visit
+                continue
+            heapq.heappush(queue, (predicted, user_id))
+        return queue
+
+    def tick(self, now=None):
+        """Starts whatever refreshes are due. Returns the user ids started."""
+        now = now or time.time()
+        self.in_flight = set(user_id for user_id in self.in_flight if self.is_running(user_id))
+        if self.budget_left(now) <= 0:
+            return []
+        off_peak = self.is_off_peak(now)
+        slots = (self.off_peak_max_jobs if off_peak else self.max_jobs) - len(self.in_flight)
+        if slots <= 0:
+            return []
+
+        queue = self.due(now, self.off_peak_horizon if off_peak else self.lead)
+        started = []
+        while queue and len(started) < slots:
+            _, user_id = heapq.heappop(queue)
+            if self.refresh(user_id):
+                self.in_flight.add(user_id)
+                started.append(user_id)
+        return started
+
+    def start(self):
+        """Starts ticking in a background thread, once per process."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='prewarm', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                started = self.tick()
+                if started:
+                    print(f'prewarming {len(started)} timelines')
+            except Exception as e:
+                print(f'Prewarming failed: {e}')
+            time.sleep(self.interval)
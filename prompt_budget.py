@@ -0,0 +1,79 @@
+import re
+from llm import estimate_text_tokens, truncate_text
+
+# Below this, a thread says too little to be worth including at all
+MIN_THREAD_TOKENS = 48
+# The blank line between threads in a prompt
+SEPARATOR_TOKENS = 1
+REPEATED_RETWEET = "<RETWEET>(same as above)</RETWEET>"
+
+
+def retweet_blocks(text):
+  """Returns the (start, end) spans of the outermost <RETWEET> blocks in text."""
+  spans = []
+  depth = 0
+  start = None
+  for match in re.finditer(r'</?RETWEET>', text):
+    if match[0] == '<RETWEET>':
+      if depth == 0:
+        start = match.start()
+      depth += 1
+    elif depth:
+      depth -= 1
+      if depth == 0:
+        spans.append((start, match.end()))
+  return spans
+
+
+def dedupe_retweets(texts):
+  """Replaces retweets already quoted by an earlier text with a short marker."""
+  seen = set()
+  deduped = []
+  for text in texts:
+    pieces = []
+    last = 0
+    for start, end in retweet_blocks(text):
+      block = text[start:end]
+      pieces.append(text[last:start])
+      pieces.append(REPEATED_RETWEET if block in seen else block)
+      seen.add(block)
+      last = end
+    pieces.append(text[last:])
+    deduped.append("".join(pieces))
+  return deduped
+
+
+def fair_share(sizes, budget):
+  """The largest per-text cap that fits sizes into budget, short texts kept whole."""
+  remaining = budget
+  left = len(sizes)
+  for size in sorted(sizes):
+    cap = remaining // left
+    if size > cap:
+      return cap
+    remaining -= size
+    left -= 1
+  return max(sizes, default=0)
+
+
+def fit_texts(texts, budget, model="gpt-4"):
+  """Dedupes retweets and trims texts so that, joined by blank lines, they fit in budget tokens.
+
+  The longest texts are cut down to an equal share of whatever the shorter
+  ones leave. If that share would be under MIN_THREAD_TOKENS, an evenly
+  spaced sample of the texts is kept instead of all of them.
+  """
+  texts = dedupe_retweets(texts)
+  sizes = [estimate_text_tokens(text, model) + SEPARATOR_TOKENS for text in texts]
+  if sum(sizes) <= budget:
+    return texts
+
+  cap = fair_share(sizes, budget)
+  if cap < MIN_THREAD_TOKENS:
+    max_texts = max(1, budget // MIN_THREAD_TOKENS)
+    keep = [i * len(texts) // max_texts for i in range(max_texts)]
+    texts = [texts[i] for i in keep]
+    sizes = [sizes[i] for i in keep]
+    cap = fair_share(sizes, budget)
+  return [text if size <= cap else truncate_text(text, cap - SEPARATOR_TOKENS, model)
+          for text, size in zip(texts, sizes)]
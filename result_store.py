@@ -0,0 +1,403 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from os import environ
+from twitter import Thread
+from clustering import HashtagsThread, TweetCluster, stable_order
+from timeline import TimelineState
+
+# Bump when the encoding below changes. Rows written with another version
+# are treated as missing, which just triggers a fresh refresh.
+SCHEMA_VERSION = 2
+
+# user_threads.in_state: shown only, part of the timeline state, or in the
+# state's pending threads, which still need hashtags
+SHOWN, IN_STATE, PENDING = 0, 1, 2
+
+CLEANUP_INTERVAL = 10 * 60
+# sqlite's default limit on bound parameters is 999
+MAX_PARAMS = 500
+
+
+class Vocabulary:
+  """Interns hashtags so each one is stored once per user."""
+  def __init__(self, words=None):
+    self.words = list(words or [])
+    self.ids = {w: i for i, w in enumerate(self.words)}
+
+  def id(self, word):
+    if word not in self.ids:
+      self.ids[word] = len(self.words)
+      self.words.append(word)
+    return self.ids[word]
+
+
+def encode_cluster(cluster, vocab):
+  node = {
+    "s": cluster.summary,
+    "n": cluster.num_tweets,
+    "h": [vocab.id(h) for h in sorted(cluster.hashtags or [])],
+    # Enough to render the page without touching the threads table
+    "t": [[thread_key(t), t.first_id] for t in stable_order(cluster.threads)],
+  }
+  if cluster.subclusters:
+    node["c"] = [encode_cluster(c, vocab) for c in cluster.subclusters]
+  return node
+
+
+def dumps(value):
+  return json.dumps(value, separators=(',', ':'))
+
+
+def thread_key(thread):
+  """Names a thread by its conversation and tweets. The same tweets collapse
+  to the same text whichever timeline they came from."""
+  digest = hashlib.sha1(",".join(str(i) for i in thread.thread_ids).encode()).hexdigest()[:16]
+  return f"{thread.conversation_id}:{digest}"
+
+
+def chunks(items, size=MAX_PARAMS):
+  items = list(items)
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+
+class StoredThread:
+  """A thread as the page sees it. The full text and ids load on first access."""
+  def __init__(self, store, key, first_id):
+    self.store = store
+    self.key = key
+    self.first_id = first_id
+    self._row = None
+
+  def _load(self):
+    if self._row is None:
+      self._row = self.store.thread_row(self.key)
+    return self._row
+
+  @property
+  def conversation_id(self):
+    return int(self.key.partition(':')[0])
+
+  @property
+  def text(self):
+    return self._load()[0]
+
+  @property
+  def thread_ids(self):
+    return self._load()[1]
+
+
+class StoredCluster:
+  def __init__(self, summary, num_tweets, hashtags, threads, subclusters):
+    self.summary = summary
+    self.num_tweets = num_tweets
+    self.hashtags = hashtags
+    self.threads = threads
+    self.subclusters = subclusters
+
+
+UPSERT_HASHTAGGED = """
+  INSERT INTO shared_threads VALUES (?, ?, ?, ?, ?, ?, ?)
+  ON CONFLICT (key) DO UPDATE SET hashtags = excluded.hashtags, updated_at = excluded.updated_at
+"""
+
+
+class ResultStore:
+  """Per-user results and timeline state in one sqlite file.
+
+  Threads are stored once, in shared_threads, no matter how many users'
+  timelines they turn up in; users only keep their thread keys. Threads the
+  llm engine has hashtagged for one user are reused for everyone else.
+
+  Every save is a single transaction and sqlite serializes writers across
+  processes. WAL mode lets pages keep reading while a refresh writes.
+  """
+  def __init__(self, path, ttl):
+    self.path = path
+    self.ttl = ttl
+    self.local = threading.local()
+    self.cleanup_thread = None
+    # Threads handed out in this process, so users share the same objects
+    self.live = weakref.WeakValueDictionary()
+    self.lock = threading.Lock()
+    self.lookups = 0
+    self.reused = 0
+    with self.connection() as conn:
+      if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        # Version 1 kept a copy of every thread per user
+        conn.execute('DROP TABLE IF EXISTS threads')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+      conn.executescript("""
+        CREATE TABLE IF NOT EXISTS results (
+          user_id TEXT PRIMARY KEY,
+          schema_version INTEGER NOT NULL,
+          saved_at REAL NOT NULL,
+          expires_at REAL NOT NULL,
+          vocabulary TEXT NOT NULL,
+          clusters TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_results_expires_at ON results (expires_at);
+        CREATE TABLE IF NOT EXISTS states (
+          user_id TEXT PRIMARY KEY,
+          schema_version INTEGER NOT NULL,
+          since_id INTEGER,
+          vocabulary TEXT NOT NULL,
+          clusters TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS shared_threads (
+          key TEXT PRIMARY KEY,
+          conversation_id INTEGER NOT NULL,
+          text TEXT NOT NULL,
+          thread_ids TEXT NOT NULL,
+          created_at REAL,
+          -- llm hashtags as a JSON list, NULL for threads only the embedding engine has seen
+          hashtags TEXT,
+          updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_threads (
+          user_id TEXT NOT NULL,
+          key TEXT NOT NULL,
+          in_state INTEGER NOT NULL,
+          PRIMARY KEY (user_id, key)
+        );
+        CREATE INDEX IF NOT EXISTS ix_user_threads_key ON user_threads (key);
+      """)
+
+  def connection(self):
+    # sqlite connections can't be shared between threads
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=30)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self.local.conn = conn
+    return conn
+
+  def share(self, key, row):
+    """The live HashtagsThread for key, built from row if no one holds it yet."""
+    with self.lock:
+      thread = self.live.get(key)
+      if thread is None:
+        conversation_id, text, thread_ids, created_at, hashtags = row
+        thread = HashtagsThread(Thread(text, conversation_id, json.loads(thread_ids), created_at), json.loads(hashtags))
+        self.live[key] = thread
+      return thread
+
+  def shared_hashtags(self, threads):
+    """Returns the hashtagged version of each thread, or None where no user's
+    refresh has hashtagged that exact thread yet."""
+    keys = [thread_key(t) for t in threads]
+    with self.lock:
+      found = {key: self.live.get(key) for key in set(keys)}
+    missing = [key for key, thread in found.items() if thread is None]
+    conn = self.connection()
+    for chunk in chunks(missing):
+      for key, *row in conn.execute(
+          f'SELECT key, conversation_id, text, thread_ids, created_at, hashtags FROM shared_threads '
+          f'WHERE hashtags IS NOT NULL AND key IN ({",".join("?" * len(chunk))})', chunk):
+        found[key] = self.share(key, row)
+    shared = [found[key] for key in keys]
+    with self.lock:
+      self.lookups += len(shared)
+      self.reused += sum(1 for t in shared if t is not None)
+    return shared
+
+  def add_hashtags(self, threads):
+    """Shares freshly hashtagged threads with every other user."""
+    now = time.time()
+    rows = []
+    with self.lock:
+      for thread in threads:
+        key = thread_key(thread)
+        self.live[key] = thread
+        rows.append(self.thread_values(key, thread, now))
+    with self.connection() as conn:
+      conn.executemany(UPSERT_HASHTAGGED, rows)
+
+  def thread_values(self, key, thread, now):
+    hashtags = getattr(thread, 'hashtags', None)
+    return (key, thread.conversation_id, thread.text, dumps(thread.thread_ids), thread.created_at,
+            None if hashtags is None else dumps(hashtags), now)
+
+  def save(self, user_id, clusters, state=None):
+    """Replaces the user's results (and timeline state, if given) atomically.
+    Without a state, the stored one is left alone."""
+    user_id = str(user_id)
+    now = time.time()
+    vocab = Vocabulary()
+    encoded = dumps([encode_cluster(c, vocab) for c in clusters])
+
+    shown = {}
+    def collect(cluster):
+      for t in cluster.threads:
+        shown[thread_key(t)] = t
+      for c in cluster.subclusters or []:
+        collect(c)
+    for cluster in clusters:
+      collect(cluster)
+    in_state = {}
+    pending = {}
+    if state is not None:
+      in_state = {thread_key(t): t for t in state.threads.values()}
+      pending = {thread_key(t): t for t in state.pending.values()}
+      state_clusters = dumps([encode_cluster(c, vocab) for c in state.clusters])
+    # One vocabulary covers the results and the state
+    words = dumps(vocab.words)
+
+    with self.connection() as conn:
+      conn.execute('BEGIN IMMEDIATE')
+      conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                   (user_id, SCHEMA_VERSION, now, now + self.ttl, words, encoded))
+      if state is not None:
+        conn.execute('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?)',
+                     (user_id, SCHEMA_VERSION, state.since_id, words, state_clusters))
+      # State threads carry llm hashtags. Threads that are only shown may be
+      # the embedding engine's, whose hashtags mustn't be reused.
+      conn.executemany(UPSERT_HASHTAGGED, [self.thread_values(key, t, now) for key, t in in_state.items()])
+      conn.executemany(
+        'INSERT OR IGNORE INTO shared_threads VALUES (?, ?, ?, ?, ?, NULL, ?)',
+        [(key, t.conversation_id, t.text, dumps(t.thread_ids), t.created_at, now)
+         for key, t in {**shown, **pending}.items() if key not in in_state])
+      if state is None:
+        # Results from another engine. The llm state stays as it was, threads
+        # and all, or its since_id would skip everything it no longer has
+        conn.execute('DELETE FROM user_threads WHERE user_id = ? AND in_state = ?', (user_id, SHOWN))
+        conn.executemany('INSERT OR IGNORE INTO user_threads VALUES (?, ?, ?)',
+                         [(user_id, key, SHOWN) for key in shown])
+      else:
+        conn.execute('DELETE FROM user_threads WHERE user_id = ?', (user_id,))
+        conn.executemany('INSERT INTO user_threads VALUES (?, ?, ?)',
+                         [(user_id, key, PENDING if key in pending else IN_STATE if key in in_state else SHOWN)
+                          for key in {**shown, **in_state, **pending}])
+
+  def load(self, user_id):
+    """Returns (clusters, saved_at) for rendering, or None if missing or expired."""
+    user_id = str(user_id)
+    row = self.connection().execute(
+      'SELECT saved_at, vocabulary, clusters FROM results WHERE user_id = ? AND schema_version = ? AND expires_at > ?',
+      (user_id, SCHEMA_VERSION, time.time())).fetchone()
+    if row is None:
+      return None
+    saved_at, vocabulary, clusters = row
+    words = json.loads(vocabulary)
+
+    def decode(node):
+      return StoredCluster(
+        node["s"], node["n"], set(words[i] for i in node["h"]),
+        [StoredThread(self, key, first_id) for key, first_id in node["t"]],
+        [decode(c) for c in node.get("c", [])])
+    return [decode(node) for node in json.loads(clusters)], saved_at
+
+  def saved_at(self, user_id):
+    """When the user's current results were saved, or None if there are none."""
+    row = self.connection().execute(
+      'SELECT saved_at FROM results WHERE user_id = ? AND schema_version = ? AND expires_at > ?',
+      (str(user_id), SCHEMA_VERSION, time.time())).fetchone()
+    return row and row[0]
+
+  def thread_row(self, key):
+    text, thread_ids = self.connection().execute(
+      'SELECT text, thread_ids FROM shared_threads WHERE key = ?', (key,)).fetchone()
+    return text, json.loads(thread_ids)
+
+  def load_state(self, user_id):
+    """Rebuilds the user's TimelineState, or returns None if there isn't a usable one."""
+    user_id = str(user_id)
+    conn = self.connection()
+    row = conn.execute('SELECT since_id, vocabulary, clusters FROM states WHERE user_id = ? AND schema_version = ?',
+                       (user_id, SCHEMA_VERSION)).fetchone()
+    if row is None:
+      return None
+    since_id, vocabulary, clusters = row
+    words = json.loads(vocabulary)
+
+    state = TimelineState()
+    state.since_id = since_id
+    by_key = {}
+    for key, *row in conn.execute(
+        'SELECT key, conversation_id, text, thread_ids, created_at, hashtags FROM user_threads '
+        'JOIN shared_threads USING (key) WHERE user_id = ? AND in_state = ? AND hashtags IS NOT NULL',
+        (user_id, IN_STATE)):
+      thread = by_key[key] = self.share(key, row)
+      state.threads[thread.conversation_id] = thread
+    # Hashtagged again on the next refresh, or taken from whoever has since
+    for conversation_id, text, thread_ids, created_at in conn.execute(
+        'SELECT conversation_id, text, thread_ids, created_at FROM user_threads '
+        'JOIN shared_threads USING (key) WHERE user_id = ? AND in_state = ?', (user_id, PENDING)):
+      state.pending[conversation_id] = Thread(text, conversation_id, json.loads(thread_ids), created_at)
+    for node in json.loads(clusters):
+      members = set(by_key[key] for key, _ in node["t"] if key in by_key)
+      state.clusters.append(TweetCluster(members, hashtags=set(words[i] for i in node["h"]), summary=node["s"]))
+    return state
+
+  def dedup_stats(self):
+    """How much sharing threads between users saves.
+
+    dedup_ratio is thread references across users' timelines per stored
+    thread, and tweet_dedup_ratio the same for the tweets in them. reused is
+    how many of the threads refreshes needed hashtags for were already
+    hashtagged, out of lookups, since this process started.
+    """
+    conn = self.connection()
+    references, tweet_references = conn.execute(
+      'SELECT COUNT(*), COALESCE(SUM(json_array_length(thread_ids)), 0) FROM user_threads JOIN shared_threads USING (key)').fetchone()
+    unique, tweets = conn.execute(
+      'SELECT COUNT(*), COALESCE(SUM(json_array_length(thread_ids)), 0) FROM shared_threads '
+      'WHERE key IN (SELECT key FROM user_threads)').fetchone()
+    with self.lock:
+      lookups, reused = self.lookups, self.reused
+    return {
+      "thread_references": references,
+      "unique_threads": unique,
+      "dedup_ratio": references / unique if unique else 1.0,
+      "tweet_references": tweet_references,
+      "unique_tweets": tweets,
+      "tweet_dedup_ratio": tweet_references / tweets if tweets else 1.0,
+      "lookups": lookups,
+      "reused": reused,
+    }
+
+  def cleanup(self, now=None):
+    now = now or time.time()
+    with self.connection() as conn:
+      conn.execute('BEGIN IMMEDIATE')
+      expired = [row[0] for row in conn.execute('SELECT user_id FROM results WHERE expires_at <= ?', (now,))]
+      for user_id in expired:
+        conn.execute('DELETE FROM results WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM states WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM user_threads WHERE user_id = ?', (user_id,))
+      # Hashtagged threads linger for a while even unreferenced, since the
+      # refresh that hashtagged them may not have saved yet
+      conn.execute('DELETE FROM shared_threads WHERE updated_at <= ? AND key NOT IN (SELECT key FROM user_threads)',
+                   (now - self.ttl,))
+    return len(expired)
+
+  def start_cleanup(self, interval=CLEANUP_INTERVAL):
+    if self.cleanup_thread is not None:
+      return
+
+    def run():
+      while True:
+        time.sleep(interval)
+        try:
+          self.cleanup()
+        except Exception as e:
+          print(f"Result store cleanup failed: {e}")
+
+    self.cleanup_thread = threading.Thread(target=run, name='result-store-cleanup', daemon=True)
+    self.cleanup_thread.start()
+
+
+_store = None
+
+def get_store():
+  global _store
+  if _store is None:
+    _store = ResultStore(environ.get('RESULT_STORE_PATH', '/tmp/results.db'),
+                         ttl=int(environ.get('RESULT_TTL', 24 * 60 * 60)))
+    _store.start_cleanup()
+  return _store
@@ -0,0 +1,61 @@
+from os import environ
+from llm import chat_completion
+from metrics import record_escalation
+
+# The last line of the summary prompts, in each prompt variant
+THINK_OUT_LOUD = "Think out loud, then state the topic prefixed with the TOPIC label."
+ANSWER_DIRECTLY = "Do not think out loud. Answer with a single line: the topic prefixed with the TOPIC label."
+
+# model:variant tiers, tried in order. A later tier only runs when the
+# earlier ones' answers fail to parse. Override with e.g. SUMMARY_ROUTE.
+DEFAULT_ROUTES = {
+  "summary": "gpt-3.5-turbo:direct,gpt-4:reasoning",
+  "meta_summary": "gpt-3.5-turbo:direct,gpt-4:reasoning",
+  "resummary": "gpt-3.5-turbo:direct,gpt-4:direct",
+  "joint_meta_summary": "gpt-3.5-turbo:direct,gpt-4:direct",
+}
+# Starts the summary routed_completion gives back when every tier failed
+ERROR_PREFIX = "Error parsing model output: "
+
+
+def route(stage):
+  tiers = []
+  for tier in environ.get(f'{stage.upper()}_ROUTE', DEFAULT_ROUTES[stage]).split(','):
+    model, _, variant = tier.strip().partition(':')
+    tiers.append((model, variant or "direct"))
+  return tiers
+
+
+def prompt_variants(prompt):
+  """Chat messages for each prompt variant of prompt."""
+  variants = {"reasoning": prompt, "direct": prompt.replace(THINK_OUT_LOUD, ANSWER_DIRECTLY)}
+  return {variant: [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": content}
+  ] for variant, content in variants.items()}
+
+
+async def routed_completion(stage, prompts, parse):
+  """Asks each tier of the stage's route until parse() accepts an answer.
+
+  prompts maps prompt variants to messages (see prompt_variants), and parse
+  returns None for answers it can't use. If no tier's answer parses,
+  returns an error message with the last answer.
+  """
+  response_text = "API error"
+  for model, variant in route(stage):
+    text = await chat_completion(model, prompts[variant], err_return=None, stage=f"{stage}/{model}")
+    if text is None:
+      continue
+    response_text = text
+    parsed = parse(text)
+    if parsed is not None:
+      return parsed
+    print(f"Couldn't parse {model}'s {stage}, escalating. Output: {text}")
+    record_escalation(stage, model)
+  return f"{ERROR_PREFIX}{response_text}"
+
+
+def failed(summary):
+  """Whether summary is routed_completion's error message rather than a summary."""
+  return bool(summary) and summary.startswith(ERROR_PREFIX)
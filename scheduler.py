@@ -0,0 +1,189 @@
+import asyncio
+import random
+import threading
+import time
+from os import environ
+from metrics import record_give_up, record_retry
+
+# (requests per minute, tokens per minute)
+MODEL_LIMITS = {
+  "gpt-4": (200, 40000),
+  "gpt-3.5-turbo": (3500, 90000),
+}
+DEFAULT_LIMITS = (200, 40000)
+
+# One scheduler serves every event loop in the process: the job runner's,
+# the server's (async views under uvicorn) and, under the Flask dev server, a
+# fresh loop per request. So nothing here may hold loop-bound primitives like
+# asyncio.Semaphore. State is guarded by a threading.Lock and waiters poll
+# with asyncio.sleep instead.
+POLL_INTERVAL = 0.05
+
+
+class TokenBucket:
+  def __init__(self, per_minute):
+    self.capacity = per_minute
+    self.level = per_minute
+    self.rate = per_minute / 60
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def refill(self):
+    # Call with the lock held
+    now = time.monotonic()
+    self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def try_take(self, amount):
+    """Takes amount from the bucket, or returns how long to wait until it could."""
+    amount = min(amount, self.capacity)
+    with self.lock:
+      self.refill()
+      if self.level >= amount:
+        self.level -= amount
+        return 0
+      return (amount - self.level) / self.rate
+
+  async def take(self, amount):
+    while (wait := self.try_take(amount)) > 0:
+      await asyncio.sleep(wait)
+
+
+class ModelLimiter:
+  def __init__(self, requests_per_minute, tokens_per_minute):
+    self.requests = TokenBucket(requests_per_minute)
+    self.tokens = TokenBucket(tokens_per_minute)
+    self.blocked_until = 0
+
+  def block_for(self, seconds):
+    # A 429 means the whole account is over the limit, so hold back every
+    # caller for this model, not just the one that got rejected
+    self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+  def try_acquire(self, num_tokens):
+    """Takes a request and num_tokens right away if both buckets have room, or neither."""
+    if self.blocked_until > time.monotonic():
+      return False
+    num_tokens = min(num_tokens, self.tokens.capacity)
+    with self.requests.lock, self.tokens.lock:
+      self.requests.refill()
+      self.tokens.refill()
+      if self.requests.level < 1 or self.tokens.level < num_tokens:
+        return False
+      self.requests.level -= 1
+      self.tokens.level -= num_tokens
+      return True
+
+  async def acquire(self, num_tokens):
+    while (wait := self.blocked_until - time.monotonic()) > 0:
+      await asyncio.sleep(wait)
+    await self.requests.take(1)
+    await self.tokens.take(num_tokens)
+
+
+def retry_after(error):
+  headers = getattr(error, 'headers', None) or {}
+  try:
+    return float(headers.get('retry-after') or headers.get('Retry-After'))
+  except (TypeError, ValueError):
+    return None
+
+
+def is_rate_limit(error):
+  return getattr(error, 'http_status', None) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+class RequestScheduler:
+  def __init__(self, max_concurrency, max_attempts=3, deadline=120):
+    self.max_concurrency = max_concurrency
+    self.max_attempts = max_attempts
+    self.deadline = deadline
+    self.in_flight = 0
+    self.lock = threading.Lock()
+    self.limiters = {}
+
+  def limiter(self, model):
+    with self.lock:
+      if model not in self.limiters:
+        self.limiters[model] = ModelLimiter(*MODEL_LIMITS.get(model, DEFAULT_LIMITS))
+      return self.limiters[model]
+
+  def _try_enter(self):
+    with self.lock:
+      if self.in_flight < self.max_concurrency:
+        self.in_flight += 1
+        return True
+      return False
+
+  def _exit(self):
+    with self.lock:
+      self.in_flight -= 1
+
+  def try_start_extra(self, model, num_tokens):
+    """Takes a concurrency slot and rate limit room for a request that skips
+    the queue, such as a hedge, if both are free right now. Call
+    finish_extra() once it's done."""
+    if not self._try_enter():
+      return False
+    if not self.limiter(model).try_acquire(num_tokens):
+      self._exit()
+      return False
+    return True
+
+  def finish_extra(self):
+    self._exit()
+
+  async def _attempt(self, func, limiter, num_tokens, give_up_at):
+    await asyncio.wait_for(limiter.acquire(num_tokens), give_up_at - time.monotonic())
+    while not self._try_enter():
+      if time.monotonic() > give_up_at:
+        raise asyncio.TimeoutError()
+      await asyncio.sleep(POLL_INTERVAL)
+    try:
+      return await asyncio.wait_for(func(), give_up_at - time.monotonic())
+    finally:
+      self._exit()
+
+  async def submit(self, func, model, num_tokens, err_return, deadline=None):
+    """Runs func() under the concurrency cap and the model's rate limits.
+
+    Failed attempts are retried with jittered exponential backoff, honouring
+    Retry-After on 429s. Returns err_return once the attempts or the deadline
+    are used up.
+    """
+    limiter = self.limiter(model)
+    give_up_at = time.monotonic() + (deadline or self.deadline)
+    for attempt in range(1, self.max_attempts + 1):
+      if time.monotonic() >= give_up_at:
+        print(f"Request to {model} hit its deadline, giving up.")
+        record_give_up(model, "deadline")
+        break
+      try:
+        return await self._attempt(func, limiter, num_tokens, give_up_at)
+      except Exception as e:
+        if attempt == self.max_attempts:
+          print(f"Request to {model} failed on attempt {attempt}, giving up. Error: {str(e)}")
+          record_give_up(model, "attempts")
+          break
+        wait_time = random.uniform(0, 2 ** attempt)
+        record_retry(model, "rate_limit" if is_rate_limit(e) else type(e).__name__)
+        if is_rate_limit(e):
+          wait_time = max(wait_time, retry_after(e) or 2 ** attempt)
+          limiter.block_for(wait_time)
+        wait_time = min(wait_time, max(give_up_at - time.monotonic(), 0))
+        print(f"Request to {model} failed on attempt {attempt}. Retrying in {wait_time:.1f} seconds. Error: {str(e)}")
+        await asyncio.sleep(wait_time)
+    return err_return
+
+
+_scheduler = None
+
+def get_scheduler():
+  global _scheduler
+  if _scheduler is None:
+    _scheduler = RequestScheduler(
+      max_concurrency=int(environ.get('LLM_MAX_CONCURRENCY', 16)),
+      max_attempts=int(environ.get('LLM_MAX_ATTEMPTS', 3)),
+      deadline=float(environ.get('LLM_DEADLINE', 120)),
+    )
+  return _scheduler
@@ -1,7 +1,10 @@
-import openai
+from os import environ
 from twitter import Thread
+from prompt_budget import fit_texts
+from routing import routed_completion, prompt_variants, failed
+from summary_memo import get_memo
 import asyncio
-from clustering import with_retries, TweetCluster
+from clustering import stable_order, TweetCluster
 import re
 import time
 from collections import Counter
@@ -22,44 +25,49 @@ What topic do all TWEETS have in common? Rules:
 
 Think out loud, then state the topic prefixed with the TOPIC label."""
 
-async def generate_summary(cluster):
-  if cluster.summary:
-    return cluster
+# Prompt tokens the tweets may take up in one summary request
+SUMMARY_TOKEN_BUDGET = 3000
+
 
-  tweets_text = "\n\n".join([thread.text for thread in cluster.threads])
-  messages = [
-    {"role": "system", "content": "You are a helpful assistant."},
-    {"role": "user", "content": SUMMARY_PROMPT.format(
-      tweets_text=tweets_text,
-      num_tweets=len(cluster.threads),
-      hashtags=" ".join(cluster.hashtags)
-    )}
-  ]
+def summary_token_budget():
+  return int(environ.get('SUMMARY_TOKEN_BUDGET', SUMMARY_TOKEN_BUDGET))
 
-  async def get_summary():
-    print("sending request...")
-    response = await openai.ChatCompletion.acreate(
-      model="gpt-4",
-      # model="gpt-3.5-turbo",
-      messages=messages
-    )
-    return response.choices[0].message['content'].strip()
 
-  response_text = await with_retries(get_summary, "API error")
+def parse_topic(response_text):
+  """Returns what the TOPIC line says the tweets are about, or None."""
+  summary = None
+  for line in response_text.split("\n"):
+    if "TOPIC" in line:
+      summary = line[line.index("TOPIC") + len("TOPIC") + 1:]
+  if not summary:
+    return None
+  summary = summary.strip().strip('"')
+  if 'about' not in summary:
+    return None
+  _, summary = summary.split('about', 1)
+  return summary
 
-  try:
-    lines = response_text.split("\n")
-    summary = None
-    for line in lines:
-      if "TOPIC" in line:
-        summary = line[len("TOPIC")+1:]
 
-    if summary:
-      summary = summary.strip('"')
-      _, summary = summary.split('about', 1)
-  except:
-    summary = f"Error parsing model output: {response_text}"
+async def generate_summary(cluster):
+  if cluster.summary:
+    return cluster
+  memo = get_memo() if cluster.hashtags else None
+  if memo is not None:
+    # sqlite, so off the event loop
+    summary = await asyncio.to_thread(memo.get, cluster)
+    if summary is not None:
+      return TweetCluster(cluster.threads, hashtags=cluster.hashtags, summary=summary)
 
+  texts = fit_texts([thread.text for thread in stable_order(cluster.threads)], summary_token_budget())
+  tweets_text = "\n\n".join(texts)
+  prompt = SUMMARY_PROMPT.format(
+    tweets_text=tweets_text,
+    num_tweets=len(cluster.threads),
+    hashtags=" ".join(sorted(cluster.hashtags))
+  )
+  summary = await routed_completion("summary", prompt_variants(prompt), parse_topic)
+  if memo is not None and not failed(summary):
+    await asyncio.to_thread(memo.set, cluster, summary)
   return TweetCluster(cluster.threads, hashtags=cluster.hashtags, summary=summary)
 
 
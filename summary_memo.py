@@ -0,0 +1,178 @@
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+from os import environ
+from metrics import record_memo_lookup
+
+# MinHash signature length, split into bands for finding candidates. Clusters
+# with Jaccard similarity 0.8 share a band with probability ~0.9998, and at
+# 0.5 with ~0.64, so few candidates need checking exactly
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+MERSENNE_PRIME = (1 << 61) - 1
+# Candidates compared exactly per lookup
+MAX_CANDIDATES = 50
+# How often (in inserts) expired and least-recently-used entries are swept
+EVICTION_INTERVAL = 100
+
+_rng = random.Random(0)
+PERMUTATIONS = [(_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(MERSENNE_PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def members(cluster):
+  return sorted(set(thread.conversation_id for thread in cluster.threads))
+
+
+def fingerprint(conversation_ids, hashtags):
+  payload = json.dumps([sorted(conversation_ids), sorted(hashtags or [])], separators=(',', ':'))
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def minhash(conversation_ids):
+  hashes = [int.from_bytes(hashlib.blake2b(str(i).encode(), digest_size=8).digest(), 'big')
+            for i in conversation_ids]
+  return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+
+def band_keys(signature):
+  return [f"{band}:" + ",".join(str(v) for v in signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+          for band in range(BANDS)]
+
+
+def jaccard(a, b):
+  a, b = set(a), set(b)
+  return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class SummaryMemo:
+  """Cluster summaries, keyed by a fingerprint of the cluster's conversations
+  and pivot hashtags, so a cluster seen before (on this timeline or another
+  user's) isn't summarized again.
+
+  A cluster that isn't an exact match reuses the summary of a stored one
+  whose membership is at least similarity alike (Jaccard), found through
+  MinHash bands. Summaries don't include the tweet count, which the page
+  renders from the cluster itself, so they carry over as they are.
+
+  Entries expire ttl seconds after they're written, and past max_entries the
+  least recently used go first.
+  """
+  def __init__(self, path, similarity=0.8, ttl=7 * 24 * 60 * 60, max_entries=100000):
+    self.similarity = similarity
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.inserts = 0
+    self.counts = {"exact": 0, "approximate": 0, "miss": 0}
+    # uvicorn workers share the file, so let sqlite do the cross-process locking
+    self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('PRAGMA synchronous=NORMAL')
+    self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS summary_memo (
+        key TEXT PRIMARY KEY,
+        members TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+      )""")
+    self.conn.execute('CREATE INDEX IF NOT EXISTS ix_summary_memo_accessed_at ON summary_memo (accessed_at)')
+    self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS summary_memo_bands (
+        band TEXT NOT NULL,
+        key TEXT NOT NULL,
+        PRIMARY KEY (band, key)
+      )""")
+    self.conn.execute('CREATE INDEX IF NOT EXISTS ix_summary_memo_bands_key ON summary_memo_bands (key)')
+
+  def record(self, result):
+    with self.lock:
+      self.counts[result] += 1
+    record_memo_lookup(result)
+
+  def get(self, cluster):
+    """The summary memoized for cluster or one much like it, or None."""
+    ids = members(cluster)
+    key = fingerprint(ids, cluster.hashtags)
+    now = time.time()
+    with self.lock:
+      row = self.conn.execute('SELECT summary FROM summary_memo WHERE key = ? AND created_at >= ?',
+                              (key, now - self.ttl)).fetchone()
+      if row is None:
+        row = self._similar(ids, now)
+      else:
+        row = (key, row[0], "exact")
+      if row is not None:
+        self.conn.execute('UPDATE summary_memo SET accessed_at = ? WHERE key = ?', (now, row[0]))
+    if row is None:
+      self.record("miss")
+      return None
+    self.record(row[2])
+    return row[1]
+
+  def _similar(self, ids, now):
+    bands = band_keys(minhash(ids))
+    candidates = self.conn.execute(f"""
+      SELECT m.key, m.members, m.summary FROM summary_memo m
+      WHERE m.key IN (SELECT DISTINCT key FROM summary_memo_bands WHERE band IN ({",".join("?" * len(bands))}))
+        AND m.created_at >= ?
+      LIMIT ?""", (*bands, now - self.ttl, MAX_CANDIDATES)).fetchall()
+    best, best_similarity = None, self.similarity
+    for key, stored, summary in candidates:
+      similarity = jaccard(ids, json.loads(stored))
+      if similarity >= best_similarity:
+        best, best_similarity = (key, summary, "approximate"), similarity
+    return best
+
+  def set(self, cluster, summary):
+    ids = members(cluster)
+    key = fingerprint(ids, cluster.hashtags)
+    now = time.time()
+    with self.lock:
+      self.conn.execute('BEGIN')
+      try:
+        self.conn.execute('INSERT OR REPLACE INTO summary_memo VALUES (?, ?, ?, ?, ?)',
+                          (key, json.dumps(ids), summary, now, now))
+        self.conn.executemany('INSERT OR IGNORE INTO summary_memo_bands VALUES (?, ?)',
+                              [(band, key) for band in band_keys(minhash(ids))])
+        self.conn.execute('COMMIT')
+      except BaseException:
+        self.conn.execute('ROLLBACK')
+        raise
+      self.inserts += 1
+      if self.inserts % EVICTION_INTERVAL == 0:
+        self._evict(now)
+
+  def _evict(self, now):
+    self.conn.execute('DELETE FROM summary_memo WHERE created_at < ?', (now - self.ttl,))
+    self.conn.execute("""
+      DELETE FROM summary_memo WHERE key IN (
+        SELECT key FROM summary_memo ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+      )""", (self.max_entries,))
+    self.conn.execute('DELETE FROM summary_memo_bands WHERE key NOT IN (SELECT key FROM summary_memo)')
+
+  def stats(self):
+    with self.lock:
+      counts = dict(self.counts)
+    total = sum(counts.values())
+    hits = counts["exact"] + counts["approximate"]
+    return {**counts, "hit_rate": hits / total if total else 0.0}
+
+
+_memo = None
+
+def get_memo():
+  """The shared memo, or None if SUMMARY_MEMO is off."""
+  global _memo
+  if _memo is None and environ.get('SUMMARY_MEMO', '1') == '1':
+    _memo = SummaryMemo(
+      environ.get('SUMMARY_MEMO_PATH', '/tmp/summary_memo.db'),
+      similarity=float(environ.get('SUMMARY_MEMO_SIMILARITY', 0.8)),
+      ttl=int(environ.get('SUMMARY_MEMO_TTL', 7 * 24 * 60 * 60)),
+      max_entries=int(environ.get('SUMMARY_MEMO_MAX_ENTRIES', 100000)),
+    )
+  return _memo
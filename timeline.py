@@ -0,0 +1,121 @@
+import time
+from twitter import Thread
+from clustering import TweetCluster, group_threads
+from routing import failed
+
+# Threads whose newest tweet is older than this drop off the timeline
+WINDOW = 24 * 60 * 60
+MAX_CLUSTER_SIZE = 7
+MIN_CLUSTER_SIZE = 4
+
+
+class TimelineState:
+  """What we know about a user's timeline between refreshes."""
+  def __init__(self):
+    # Newest tweet seen so far, passed to the API as since_id
+    self.since_id = None
+    # conversation_id -> HashtagsThread
+    self.threads = {}
+    # conversation_id -> Thread whose hashtagging failed, to be retried on
+    # the next refresh. Its tweets are already behind since_id
+    self.pending = {}
+    # Summarized clusters from the last refresh, excluding misc
+    self.clusters = []
+
+  def update_since_id(self, threads):
+    # Snowflake ids grow over time and referenced tweets are always older
+    # than the tweets referencing them, so the max id is the newest tweet
+    ids = [tweet_id for thread in threads for tweet_id in thread.thread_ids]
+    if ids:
+      self.since_id = max([int(i) for i in ids] + [int(self.since_id or 0)])
+
+
+def merge_thread(old, new):
+  """Combines a conversation we've already seen with its newer tweets."""
+  # Timelines come newest first, so the new tweets go on top
+  text = old.text if new.text in old.text else new.text + "\n" + old.text
+  created_at = max(filter(None, [old.created_at, new.created_at]), default=None)
+  return Thread(text, old.conversation_id, [*new.thread_ids, *old.thread_ids], created_at)
+
+
+def slot_thread(clusters, thread):
+  """Returns the open cluster sharing most of its pivot hashtags with thread, if any."""
+  best, best_overlap = None, 0
+  for cluster in clusters:
+    if len(cluster.threads) >= MAX_CLUSTER_SIZE or not cluster.hashtags:
+      continue
+    overlap = len(set(cluster.hashtags) & set(thread.hashtags))
+    # Same spirit as pack_cluster's majority rule
+    if overlap > best_overlap and overlap * 2 >= len(cluster.hashtags):
+      best, best_overlap = cluster, overlap
+  return best
+
+
+def merge_new_threads(state, new_threads):
+  """Combines fetched threads with the versions already in state. These, and
+  threads still pending from the last refresh, are what need hashtagging."""
+  merged = []
+  for thread in new_threads:
+    # A pending thread is newer than the hashtagged version of it
+    known = state.pending.get(thread.conversation_id) or state.threads.get(thread.conversation_id)
+    merged.append(merge_thread(known, thread) if known else thread)
+  fetched = set(t.conversation_id for t in new_threads)
+  return merged + [t for conversation_id, t in state.pending.items() if conversation_id not in fetched]
+
+
+def update_clusters(state, hashtagged, now=None, dry_run=False, locked=()):
+  """Folds hashtagged threads into the state's clusters.
+
+  New threads join existing clusters where they fit, and whatever is left
+  over is grouped from scratch. Clusters whose membership changed lose their
+  summary so they get re-summarized; untouched clusters keep theirs, unless
+  it was an error. Returns
+  the clusters, misc last. With dry_run, state is left as it was, so this can
+  be called on a partial set of hashtagged threads to see where they'd go.
+
+  locked clusters are kept exactly as they are, and their threads aren't
+  placed anywhere else.
+  """
+  now = now or time.time()
+  threads = dict(state.threads) if dry_run else state.threads
+
+  changed = set()
+  for thread in hashtagged:
+    threads[thread.conversation_id] = thread
+    changed.add(thread.conversation_id)
+  for conversation_id, thread in list(threads.items()):
+    if thread.created_at and now - thread.created_at > WINDOW:
+      del threads[conversation_id]
+      changed.add(conversation_id)
+  if not dry_run:
+    for conversation_id, thread in list(state.pending.items()):
+      if thread.created_at and now - thread.created_at > WINDOW:
+        del state.pending[conversation_id]
+
+  clusters = []
+  assigned = set(t.conversation_id for cluster in locked for t in cluster.threads)
+  for cluster in state.clusters:
+    conversation_ids = [t.conversation_id for t in cluster.threads
+                        if t.conversation_id in threads and t.conversation_id not in assigned]
+    if len(conversation_ids) < MIN_CLUSTER_SIZE:
+      # Too small now, let its threads be regrouped
+      continue
+    touched = len(conversation_ids) < len(cluster.threads) or any(t.conversation_id in changed for t in cluster.threads)
+    # A summary that failed last time is tried again
+    touched = touched or failed(cluster.summary)
+    clusters.append(TweetCluster(set(threads[c] for c in conversation_ids), hashtags=cluster.hashtags,
+                                 summary=None if touched else cluster.summary))
+    assigned.update(conversation_ids)
+
+  for thread in hashtagged:
+    if thread.conversation_id in assigned:
+      continue
+    cluster = slot_thread(clusters, thread)
+    if cluster:
+      cluster.add_thread(thread)
+      cluster.summary = None
+      assigned.add(thread.conversation_id)
+
+  leftovers = [thread for conversation_id, thread in threads.items() if conversation_id not in assigned]
+  return clusters + list(locked) + group_threads(leftovers)
+
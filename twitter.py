@@ -1,18 +1,37 @@
-import tweepy
+import asyncio
+import aiohttp
+import yarl
+from tweepy.asynchronous import AsyncClient
 from os import environ
 from datetime import datetime, timedelta
 import re
 
-tweet_fields = ["text", "referenced_tweets", "author_id", "conversation_id"]
+tweet_fields = ["text", "referenced_tweets", "author_id", "conversation_id", "created_at"]
 expansions = ["referenced_tweets.id"]
+TWITTER_API_BASE = "https://api.twitter.com"
 
 class Thread():
-    def __init__(self, text, conversation_id, thread_ids):
+    __slots__ = ('text', 'conversation_id', 'thread_ids', 'created_at')
+
+    def __init__(self, text, conversation_id, thread_ids, created_at=None):
         self.text = text
         self.conversation_id = conversation_id
         self.thread_ids = thread_ids
+        # Unix time of the newest tweet in the thread
+        self.created_at = created_at
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # Threads pickled before we tracked timestamps don't have one
+        self.__init__(state['text'], state['conversation_id'], state['thread_ids'], state.get('created_at'))
+
+    @property
+    def first_id(self):
+        return self.thread_ids[0]
 
-def expand_retweets(tweet, include_tweets, client):
+def expand_retweets(tweet, include_by_id, client):
     # Remove included retweet text, we'll add it later
     tweet_text = re.sub(r'\bRT\b.*', '', tweet.text)
 
@@ -20,47 +39,162 @@ def expand_retweets(tweet, include_tweets, client):
         return tweet_text, [tweet.id]
     else:
         retweet_id = tweet.referenced_tweets[0].id
-        retweet = next((retweet for retweet in include_tweets if retweet.id == retweet_id), None)
+        retweet = include_by_id.get(retweet_id)
         # TODO (mitchg) - we can't expand retweets rn because we're hitting an API limit on the get_tweet endpoint
         # if not retweet:
         #     response = client.get_tweet(retweet_id, tweet_fields=tweet_fields, expansions=expansions)
         #     retweet = response.data
-        #     include_tweets = response.includes.get('tweets')
+        #     include_by_id.update((t.id, t) for t in response.includes.get('tweets', []))
         if retweet:
-            expanded_text, expanded_ids = expand_retweets(retweet, include_tweets, client)
+            expanded_text, expanded_ids = expand_retweets(retweet, include_by_id, client)
             return tweet_text + f"<RETWEET>\n{expanded_text}\n</RETWEET>", [tweet.id, *expanded_ids]
         else:
             return tweet_text, [tweet.id]
 
 
-def fetch_tweets(access_token, access_token_secret):
-    client = tweepy.Client(bearer_token=environ.get("BEARER_TOKEN"), 
-                           consumer_key=environ.get('TWITTER_API_KEY'), 
-                           consumer_secret=environ.get('TWITTER_API_SECRET'), 
-                           access_token=access_token, 
-                           access_token_secret=access_token_secret)
+# Length of the text pieces ThreadText indexes
+GRAM = 8
+# Indexing a byte of thread costs about as much as searching this many
+# (benchmarks/collapse_scaling measures both)
+INDEX_COST = 1000
 
-    now = datetime.now()
-    date_24_hours_ago = now - timedelta(hours=24)
 
-    # fetch the tweets
-    response = client.get_home_timeline(start_time=date_24_hours_ago, tweet_fields=tweet_fields, expansions=expansions)
+def encode(text):
+    # Tweets may carry lone surrogates, which plain UTF-8 refuses
+    return text.encode('utf-8', 'surrogatepass')
 
-    # create a dictionary to store the collapsed tweets
-    collapsed_tweets = {}
-    convo_thread_ids = {}
 
-    for tweet in response.data:
+class ThreadText:
+    """A conversation's text so far, for asking whether a tweet is already in it.
 
-        expanded_text, thread_ids = expand_retweets(tweet, response.includes['tweets'], client)
-        # if this tweet is part of a conversation we've seen before, append it to the existing tweet
-        if tweet.conversation_id in collapsed_tweets:
-            # TODO (mitchg) - not sure why we have to check this to prevent duplication
-            if expanded_text not in collapsed_tweets[tweet.conversation_id]:
-              collapsed_tweets[tweet.conversation_id] += "\n" + expanded_text
-            convo_thread_ids[tweet.conversation_id].extend(thread_ids)
-        else:
-            collapsed_tweets[tweet.conversation_id] = expanded_text
-            convo_thread_ids[tweet.conversation_id] = thread_ids
+    A tweet is a repeat if it's a substring of the thread, as it always was.
+    Searching the whole thread for every tweet is quadratic in its length, so
+    once those searches have cost as much as indexing the thread would, every
+    GRAM-character piece of it is kept in a set: a tweet with a piece the
+    thread doesn't have can't be in it. Only the rest, mostly real repeats,
+    are searched for. Waiting that long means a thread is only indexed once
+    it's searched often enough to pay off, and never costs more than about
+    twice the better of the two. The text is kept as UTF-8, where substrings
+    match exactly as they do in the str, because a bytearray appends in place.
+    """
+    def __init__(self, text):
+        self.segments = [text]
+        self.encoded = bytearray(encode(text))
+        self.exact = {text}
+        self.grams = None
+        self.tail = ""
+        # Bytes scanned by searches before the index was built
+        self.searched = 0
+
+    def index(self, text):
+        # Starting in the end of the text before, so pieces spanning joins count too
+        text = self.tail + text
+        self.grams.update(text[i:i + GRAM] for i in range(len(text) - GRAM + 1))
+        self.tail = text[-(GRAM - 1):]
+
+    def __contains__(self, text):
+        if text in self.exact:
+            return True
+        if self.grams is None and self.searched >= INDEX_COST * len(self.encoded):
+            self.grams = set()
+            self.index(str(self))
+        # Pieces end to end cover the tweet and are enough to rule most out
+        if self.grams is not None and len(text) >= GRAM and \
+                any(text[i:i + GRAM] not in self.grams for i in [*range(0, len(text) - GRAM, GRAM), len(text) - GRAM]):
+            return False
+        if self.grams is None:
+            self.searched += len(self.encoded)
+        return encode(text) in self.encoded
+
+    def append(self, text):
+        self.segments.append(text)
+        self.encoded += encode("\n" + text)
+        self.exact.add(text)
+        if self.grams is not None:
+            self.index("\n" + text)
+
+    def __str__(self):
+        return "\n".join(self.segments)
+
+
+class ThreadCollapser:
+    """Collapses timeline tweets into one Thread per conversation, a page at a time."""
+    def __init__(self, client=None):
+        self.client = client
+        # Retweets can point at tweets included with an earlier page
+        self.include_by_id = {}
+        # conversation_id -> ThreadText
+        self.collapsed_tweets = {}
+        self.convo_thread_ids = {}
+        self.convo_created_at = {}
+
+    def add_page(self, tweets, include_tweets):
+        self.include_by_id.update((t.id, t) for t in include_tweets)
+        for tweet in tweets:
+
+            expanded_text, thread_ids = expand_retweets(tweet, self.include_by_id, self.client)
+            if tweet.created_at:
+                self.convo_created_at[tweet.conversation_id] = max(self.convo_created_at.get(tweet.conversation_id, 0), tweet.created_at.timestamp())
+            # if this tweet is part of a conversation we've seen before, append it to the existing tweet
+            if tweet.conversation_id in self.collapsed_tweets:
+                # TODO (mitchg) - not sure why we have to check this to prevent duplication
+                if expanded_text not in self.collapsed_tweets[tweet.conversation_id]:
+                    self.collapsed_tweets[tweet.conversation_id].append(expanded_text)
+                self.convo_thread_ids[tweet.conversation_id].extend(thread_ids)
+            else:
+                self.collapsed_tweets[tweet.conversation_id] = ThreadText(expanded_text)
+                self.convo_thread_ids[tweet.conversation_id] = thread_ids
+
+    def threads(self):
+        return [Thread(str(text), convo_id, self.convo_thread_ids[convo_id], self.convo_created_at.get(convo_id))
+                for convo_id, text in self.collapsed_tweets.items()]
+
+
+class RebasedSession:
+    """Sends tweepy's api.twitter.com requests to another host, e.g. a local fake API."""
+    def __init__(self, session, api_base):
+        self.session = session
+        self.api_base = api_base.rstrip('/')
+
+    def request(self, method, url, **kwargs):
+        url = str(url).replace(TWITTER_API_BASE, self.api_base, 1)
+        return self.session.request(method, yarl.URL(url, encoded=True), **kwargs)
+
+
+async def fetch_tweets_async(access_token, access_token_secret, since_id=None, max_results=100, max_pages=32):
+    """Fetches the last 24 hours of home timeline, following pagination_token.
+
+    Each page is collapsed into threads while the next one is in flight.
+    Set TWITTER_API_BASE to point at a fake API for offline runs.
+    """
+    client = AsyncClient(bearer_token=environ.get("BEARER_TOKEN"),
+                         consumer_key=environ.get('TWITTER_API_KEY'),
+                         consumer_secret=environ.get('TWITTER_API_SECRET'),
+                         access_token=access_token,
+                         access_token_secret=access_token_secret)
+
+    now = datetime.now()
+    date_24_hours_ago = now - timedelta(hours=24)
+    params = dict(start_time=date_24_hours_ago, since_id=since_id, max_results=max_results,
+                  tweet_fields=tweet_fields, expansions=expansions)
+
+    collapser = ThreadCollapser()
+    # One session for every page so the connection is reused
+    async with aiohttp.ClientSession() as session:
+        api_base = environ.get('TWITTER_API_BASE')
+        client.session = RebasedSession(session, api_base) if api_base else session
+
+        next_page = asyncio.ensure_future(client.get_home_timeline(**params))
+        pages = 0
+        while next_page:
+            response = await next_page
+            pages += 1
+            next_token = response.meta.get('next_token')
+            if next_token and pages < max_pages:
+                next_page = asyncio.ensure_future(client.get_home_timeline(pagination_token=next_token, **params))
+            else:
+                next_page = None
+            if response.data:
+                collapser.add_page(response.data, response.includes.get('tweets', []))
 
-    return [Thread(text, convo_id, convo_thread_ids[convo_id]) for convo_id, text in collapsed_tweets.items()]
+    return collapser.threads()